@@ -0,0 +1,397 @@
+# /// script
+# requires-python = ">=3.10"
+# dependencies = ["duckdb"]
+# ///
+"""
+Synthetic data generator and build benchmark for the NYC Restaurant Cuisine Dashboard.
+
+`generate` writes files shaped like Open_Restaurants_Inspections_*.csv and
+subway_stations.csv at any size. `run` builds a database from generated data
+for each requested size, times every build_database stage and compares the
+timings with benchmark_baseline.json to catch regressions.
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import sys
+import tempfile
+
+import duckdb
+
+import setup
+
+BASELINE_JSON = os.path.join(setup.DATA_DIR, "benchmark_baseline.json")
+# The real extract, read for the cuisine mix; benchmark runs repoint
+# setup.RESTAURANT_CSV at generated files.
+SNAPSHOT_RESTAURANT_CSV = setup.RESTAURANT_CSV
+
+# Preset sizes: label -> (restaurants, station stops).
+SIZES = {
+    "10k": (10_000, 500),
+    "100k": (100_000, 2_000),
+    "1m": (1_000_000, 10_000),
+    "10m": (10_000_000, 50_000),
+}
+
+# Bounding box of the five boroughs, used for unclustered points and lines.
+NYC_LAT = (40.50, 40.91)
+NYC_LON = (-74.25, -73.70)
+
+CHAINS = [
+    "Starbucks", "Dunkin'", "McDonald's", "Chipotle Mexican Grill", "Sweetgreen",
+    "Joe's Pizza", "Domino's Pizza", "Le Pain Quotidien", "Shake Shack",
+    "Panera Bread", "Sushi Express", "Xi'an Famous Foods", "Taco Bell Cantina",
+    "Pret A Manger", "Levain Bakery", "Blue Bottle Coffee", "Paris Baguette",
+    "Los Tacos No. 1", "Halal Guys", "Irish Pub",
+]
+NAME_PREFIXES = [
+    "Golden", "Little", "Royal", "Blue", "Happy", "New", "Old", "Grand", "Lucky",
+    "Sunny", "Casa", "La", "El", "Le", "The", "Mama's", "Papa's", "Uncle", "Best",
+    "Brooklyn", "Queens", "Harlem", "Bronx", "Village", "Corner", "Downtown",
+]
+NAME_SUFFIXES = [
+    "Kitchen", "House", "Restaurant", "Cafe", "Grill", "Bar", "Express", "Place",
+    "Garden", "Palace", "Eatery", "Canteen", "Corner", "Spot", "Shop", "Lounge",
+]
+# Words that match no CUISINES rule, for the large unclassified share.
+GENERIC_WORDS = [
+    "Deli", "Diner", "Tavern", "Star", "Market", "Joint", "Station",
+    "Table", "Counter", "Social", "Union", "Hall", "Room", "Yard", "Club",
+]
+STREETS = [
+    "Broadway", "Amsterdam Ave", "Flatbush Ave", "Atlantic Ave", "Court St",
+    "Bedford Ave", "Steinway St", "Roosevelt Ave", "Grand Concourse", "1st Ave",
+    "2nd Ave", "3rd Ave", "Lexington Ave", "Madison Ave", "Smith St", "Main St",
+    "Queens Blvd", "Fordham Rd", "Myrtle Ave", "Nostrand Ave",
+]
+BOROUGHS = ["Manhattan", "Brooklyn", "Queens", "Bronx", "Staten Island"]
+BOROUGH_CODES = ["M", "Bk", "Q", "Bx", "SI"]
+ROUTES = list("1234567ABCDEFGJLMNQRSWZ")
+
+# Mix of name kinds; the rest are generic names no rule matches.
+CHAIN_SHARE = 0.12
+CUISINE_SHARE = 0.55
+
+
+def _cuisine_keywords(snapshot_csv=SNAPSHOT_RESTAURANT_CSV):
+    """Keywords taken from the CUISINES rules, so generated names exercise them.
+
+    Each rule's keywords are repeated as many times, in total, as the rule
+    matches a restaurant in the real `snapshot_csv`, so picking uniformly from
+    the list gives pizza places far more often than Timorese ones. Every
+    keyword appears at least once.
+    """
+    con = duckdb.connect()
+    restaurants = con.execute(f"""
+        SELECT RestaurantName
+        FROM read_csv('{snapshot_csv}',
+            auto_detect=false, header=true, delim=',', quote='"', escape='"',
+            columns={setup.RESTAURANT_CSV_COLUMNS!r},
+            timestampformat='{setup.RESTAURANT_CSV_TIMESTAMP_FORMAT}')
+        WHERE RestaurantName IS NOT NULL
+        GROUP BY RestaurantName, BusinessAddress
+    """).fetchall()
+    con.close()
+    classify = setup._compile_cuisine_classifier()
+    matches = collections.Counter(classify(name.strip()) for name, in restaurants)
+
+    keywords = []
+    for rule_index, (_, pattern) in enumerate(setup.CUISINES):
+        rule = re.compile(pattern, re.ASCII)
+        literals = []
+        for branch in setup._split_branches(pattern):
+            literal = setup._required_literal(branch)
+            # Fragments such as "chin" for chin(a|ese) do not match on their own.
+            if len(literal) >= 4 and literal.isalpha() and rule.search(literal):
+                literals.append(literal.title())
+        if not literals:
+            continue
+        count = max(matches[rule_index], len(literals))
+        keywords.extend(literals[j % len(literals)] for j in range(count))
+    return keywords
+
+
+def _macros(con):
+    # Deterministic per-row randomness: the same seed gives the same files
+    # regardless of how DuckDB parallelises the query.
+    con.execute("""
+        CREATE OR REPLACE TEMP MACRO rnd(i, salt) AS
+            (hash(i * 7919 + salt) % 1000000007) / 1000000007.0
+    """)
+    con.execute("""
+        CREATE OR REPLACE TEMP MACRO gauss(i, salt) AS
+            sqrt(-2 * ln(greatest(rnd(i, salt), 1e-12))) * cos(2 * pi() * rnd(i, salt + 1))
+    """)
+    con.execute("""
+        CREATE OR REPLACE TEMP MACRO pick(items, i, salt) AS
+            items[1 + CAST(floor(rnd(i, salt) * len(items)) AS INTEGER)]
+    """)
+
+
+def generate_stations(path, stops, seed=0, con=None):
+    """Write a subway_stations.csv-shaped file with `stops` stops.
+
+    Stops are strung along straight lines across the city, 25 per line, and
+    roughly every fourth stop shares a complex with its neighbour, like
+    transfer stations do.
+    """
+    con = con or duckdb.connect()
+    _macros(con)
+    con.execute(f"""
+        COPY (
+            WITH stops AS (
+                SELECT
+                    i,
+                    i // 25 AS line,
+                    (i % 25) / 24.0 AS t
+                FROM range({stops}) r(i)
+            ),
+            placed AS (
+                SELECT
+                    i,
+                    line,
+                    {NYC_LAT[0]} + rnd(line, {seed} + 1) * {NYC_LAT[1] - NYC_LAT[0]} AS lat0,
+                    {NYC_LON[0]} + rnd(line, {seed} + 2) * {NYC_LON[1] - NYC_LON[0]} AS lon0,
+                    {NYC_LAT[0]} + rnd(line, {seed} + 3) * {NYC_LAT[1] - NYC_LAT[0]} AS lat1,
+                    {NYC_LON[0]} + rnd(line, {seed} + 4) * {NYC_LON[1] - NYC_LON[0]} AS lon1,
+                    t
+                FROM stops
+            )
+            SELECT
+                'G' || i AS "GTFS Stop ID",
+                i AS "Station ID",
+                CASE WHEN i % 4 = 1 THEN i - 1 ELSE i END AS "Complex ID",
+                pick(['IRT', 'BMT', 'IND'], line, {seed} + 5) AS "Division",
+                'Line ' || line AS "Line",
+                pick($streets, i, {seed} + 6) || ' - ' || i AS "Stop Name",
+                pick($boroughs, i, {seed} + 7) AS "Borough",
+                rnd(i, {seed} + 8) < 0.1 AS "CBD",
+                pick($routes, line, {seed} + 9) AS "Daytime Routes",
+                pick(['Subway', 'Elevated', 'Open Cut'], i, {seed} + 10) AS "Structure",
+                round(lat0 + t * (lat1 - lat0) + gauss(i, {seed} + 11) * 0.001, 6)
+                    AS "GTFS Latitude",
+                round(lon0 + t * (lon1 - lon0) + gauss(i, {seed} + 13) * 0.001, 6)
+                    AS "GTFS Longitude",
+                'Uptown' AS "North Direction Label",
+                'Downtown' AS "South Direction Label",
+                CAST(rnd(i, {seed} + 15) < 0.3 AS INTEGER) AS "ADA",
+                0 AS "ADA Northbound",
+                0 AS "ADA Southbound",
+                NULL AS "ADA Notes",
+                NULL AS "Georeference"
+            FROM placed
+        ) TO '{path}' (HEADER, DELIMITER ',')
+    """, {"streets": STREETS, "boroughs": BOROUGH_CODES, "routes": ROUTES})
+
+
+def generate_restaurants(path, restaurants, stations_csv, inspections=2, seed=0, con=None):
+    """Write an Open_Restaurants_Inspections_*.csv-shaped file.
+
+    Each of the `restaurants` restaurants gets `inspections` rows on average.
+    Most restaurants cluster around the stations in `stations_csv`, the rest
+    are spread over the city. Names mix repeating chains, names built from
+    CUISINES keywords and generic names no rule matches.
+    """
+    con = con or duckdb.connect()
+    _macros(con)
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE anchors AS
+        SELECT
+            row_number() OVER () - 1 AS anchor,
+            "GTFS Latitude" AS lat,
+            "GTFS Longitude" AS lon
+        FROM read_csv_auto('{stations_csv}')
+    """)
+    anchors = con.execute("SELECT COUNT(*) FROM anchors").fetchone()[0]
+    # Every restaurant is inspected once; the extra rows are repeat inspections.
+    rows = restaurants * max(inspections - 1, 0)
+    con.execute(f"""
+        COPY (
+            WITH inspection AS (
+                SELECT
+                    r AS row_id,
+                    -- Spread extra inspections unevenly over restaurants.
+                    CAST(floor(pow(rnd(r, {seed} + 20), 1.5) * {restaurants}) AS BIGINT) AS i
+                FROM range({rows}) t(r)
+                UNION ALL
+                SELECT {rows} + i, i FROM range({restaurants}) t(i)
+            ),
+            restaurant AS (
+                SELECT
+                    row_id,
+                    i,
+                    rnd(i, {seed} + 21) AS kind,
+                    CAST(floor(rnd(i, {seed} + 22) * {anchors}) AS BIGINT) AS anchor,
+                    rnd(i, {seed} + 23) < 0.85 AS clustered
+                FROM inspection
+            )
+            SELECT
+                pick($boroughs, i, {seed} + 24) AS "Borough",
+                CASE
+                    WHEN kind < {CHAIN_SHARE}
+                        -- Zipf-like: the first chains are by far the most common.
+                        THEN $chains[
+                            1 + CAST(floor(pow(rnd(i, {seed} + 25), 3) * len($chains)) AS INTEGER)
+                        ]
+                    WHEN kind < {CHAIN_SHARE + CUISINE_SHARE}
+                        THEN pick($prefixes, i, {seed} + 26)
+                             || ' ' || pick($keywords, i, {seed} + 27)
+                             || ' ' || pick($suffixes, i, {seed} + 28)
+                    ELSE pick($prefixes, i, {seed} + 26) || ' ' || pick($generic, i, {seed} + 29)
+                         || ' ' || (i % 1000)
+                END AS "RestaurantName",
+                pick(['both', 'sidewalk', 'roadway'], i, {seed} + 30) AS "SeatingChoice",
+                'Synthetic ' || i || ' LLC' AS "LegalBusinessName",
+                (1 + i % 2000) || ' ' || pick($streets, i, {seed} + 31) AS "BusinessAddress",
+                row_id AS "RestaurantInspectionID",
+                NULL AS "IsSidewayCompliant",
+                pick(['Compliant', 'Non-Compliant', 'Skipped Inspection'], row_id, {seed} + 32)
+                    AS "IsRoadwayCompliant",
+                NULL AS "SkippedReason",
+                strftime(
+                    TIMESTAMP '2020-06-01'
+                        + to_seconds(CAST(rnd(row_id, {seed} + 33) * 1.5e8 AS BIGINT)),
+                    '{setup.RESTAURANT_CSV_TIMESTAMP_FORMAT}'
+                ) AS "InspectedOn",
+                'DOT' AS "AgencyCode",
+                10001 + i % 1400 AS "Postcode",
+                round(CASE WHEN clustered
+                    THEN a.lat + gauss(i, {seed} + 34) * 0.003
+                    ELSE {NYC_LAT[0]} + rnd(i, {seed} + 36) * {NYC_LAT[1] - NYC_LAT[0]}
+                END, 6) AS "Latitude",
+                round(CASE WHEN clustered
+                    THEN a.lon + gauss(i, {seed} + 37) * 0.004
+                    ELSE {NYC_LON[0]} + rnd(i, {seed} + 39) * {NYC_LON[1] - NYC_LON[0]}
+                END, 6) AS "Longitude",
+                1 + i % 18 AS "CommunityBoard",
+                1 + i % 51 AS "CouncilDistrict",
+                i % 2000 AS "CensusTract",
+                1000000 + i AS "BIN",
+                1000000000 + i AS "BBL",
+                'Synthetic NTA ' || i % 190 AS "NTA"
+            FROM restaurant
+            JOIN anchors a USING (anchor)
+        ) TO '{path}' (HEADER, DELIMITER ',')
+    """, {
+        "boroughs": BOROUGHS, "chains": CHAINS, "prefixes": NAME_PREFIXES,
+        "keywords": _cuisine_keywords(), "suffixes": NAME_SUFFIXES,
+        "generic": GENERIC_WORDS, "streets": STREETS,
+    })
+
+
+def generate(out_dir, restaurants, stops, inspections=2, seed=0):
+    """Write both synthetic CSVs into `out_dir`; returns their paths."""
+    os.makedirs(out_dir, exist_ok=True)
+    stations_csv = os.path.join(out_dir, "subway_stations.csv")
+    restaurants_csv = os.path.join(out_dir, "Open_Restaurants_Inspections_synthetic.csv")
+    con = duckdb.connect()
+    generate_stations(stations_csv, stops, seed=seed, con=con)
+    generate_restaurants(
+        restaurants_csv, restaurants, stations_csv,
+        inspections=inspections, seed=seed, con=con,
+    )
+    con.close()
+    return restaurants_csv, stations_csv
+
+
+def benchmark_size(label, repeat=1, inspections=2, seed=0):
+    """Build a database from generated data of preset size `label`.
+
+    Returns the fastest time per stage over `repeat` full builds.
+    """
+    restaurants, stops = SIZES[label]
+    with tempfile.TemporaryDirectory(prefix=f"nyc-bench-{label}-") as tmp:
+        print(f"[{label}] generating {restaurants:,} restaurants, {stops:,} stops...")
+        setup.RESTAURANT_CSV, setup.SUBWAY_CSV = generate(
+            tmp, restaurants, stops, inspections=inspections, seed=seed,
+        )
+        setup.DB_PATH = os.path.join(tmp, "bench.duckdb")
+        report_path = os.path.join(tmp, "build_report.json")
+        best = {}
+        for _ in range(repeat):
+            setup.build_database(cache_path=None, report_path=report_path, full=True)
+            with open(report_path) as f:
+                for stage in json.load(f)["stages"]:
+                    seconds = stage["seconds"]
+                    best[stage["stage"]] = min(best.get(stage["stage"], seconds), seconds)
+    return best
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """List (size, stage, baseline, now) for stages slower than the baseline allows."""
+    regressions = []
+    for label, stages in results.items():
+        for stage, seconds in stages.items():
+            before = baseline.get(label, {}).get(stage)
+            if before is None:
+                continue
+            if seconds > before * (1 + tolerance) and seconds - before > min_seconds:
+                regressions.append((label, stage, before, seconds))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="write synthetic CSVs")
+    gen.add_argument("out_dir")
+    gen.add_argument("--restaurants", type=int, default=SIZES["10k"][0])
+    gen.add_argument("--stations", type=int, default=SIZES["10k"][1],
+                     help="number of station stops")
+    gen.add_argument("--inspections", type=int, default=2,
+                     help="average inspection rows per restaurant")
+    gen.add_argument("--seed", type=int, default=0)
+
+    run = commands.add_parser("run", help="time build_database stages on synthetic data")
+    run.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["10k", "100k"])
+    run.add_argument("--repeat", type=int, default=3,
+                     help="builds per size; the fastest time per stage is kept")
+    run.add_argument("--baseline", default=BASELINE_JSON)
+    run.add_argument("--update-baseline", action="store_true",
+                     help="record these timings as the new baseline")
+    run.add_argument("--tolerance", type=float, default=0.25,
+                     help="allowed slowdown as a fraction of the baseline time")
+    run.add_argument("--min-seconds", type=float, default=0.05,
+                     help="ignore slowdowns smaller than this many seconds")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        paths = generate(args.out_dir, args.restaurants, args.stations,
+                         inspections=args.inspections, seed=args.seed)
+        print("\n".join(paths))
+        return 0
+
+    results = {label: benchmark_size(label, repeat=args.repeat) for label in args.sizes}
+
+    print("\n--- Benchmark ---")
+    for label, stages in results.items():
+        for stage, seconds in stages.items():
+            print(f"  {label:<5} {stage:<25} {seconds:>8.3f}s")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    if not baseline:
+        print(f"\nNo baseline at {args.baseline}; run with --update-baseline to record one.")
+        return 1
+    regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+    for label, stage, before, seconds in regressions:
+        print(f"  REGRESSION {label} {stage}: {before:.3f}s -> {seconds:.3f}s")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
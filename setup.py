@@ -8,17 +8,140 @@ Downloads subway station data, loads CSVs into DuckDB, classifies cuisines,
 computes nearest stations, and creates aggregated tables.
 """
 
+import argparse
+import collections
+import contextlib
+import csv
+import hashlib
+import inspect
+import json
+import math
+import re
+import shutil
+import sys
+import tempfile
+import time
+import types
 import urllib.request
 import os
 import duckdb
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import yaml
+except ImportError:  # Only needed to report dashboard payload sizes.
+    yaml = None
+
 DATA_DIR = os.path.dirname(os.path.abspath(__file__))
 SUBWAY_CSV = os.path.join(DATA_DIR, "subway_stations.csv")
 RESTAURANT_CSV = os.path.join(DATA_DIR, "Open_Restaurants_Inspections_20260107.csv")
 CUISINE_LOOKUP_TSV = os.path.join(DATA_DIR, "cuisine_lookup.tsv")
 DB_PATH = os.path.join(DATA_DIR, "nyc_food.duckdb")
+# Tables the dashboard reads; a build that leaves any of them empty is rejected.
+REQUIRED_TABLES = [
+    "restaurants_with_station", "station_cuisine_counts", "station_cuisine_rank",
+    "restaurant_markers",
+]
+# Sidecar database of classified names; survives the rebuilds of DB_PATH.
+CUISINE_CACHE_PATH = os.path.join(DATA_DIR, "cuisine_cache.duckdb")
+RULE_PROFILE_JSON = os.path.join(DATA_DIR, "rule_profile.json")
+BUILD_REPORT_JSON = os.path.join(DATA_DIR, "build_report.json")
+VISIVO_PROJECT_YML = os.path.join(DATA_DIR, "project.visivo.yml")
+SHARDS_DIR = os.path.join(DATA_DIR, "shards")
 SUBWAY_URL = "https://data.ny.gov/api/views/39hk-dx4f/rows.csv?accessType=DOWNLOAD"
 
+# Declared schema of Open_Restaurants_Inspections_*.csv, in file order, so the
+# load skips type sniffing and parses coordinates and timestamps exactly once.
+RESTAURANT_CSV_COLUMNS = {
+    "Borough": "VARCHAR",
+    "RestaurantName": "VARCHAR",
+    "SeatingChoice": "VARCHAR",
+    "LegalBusinessName": "VARCHAR",
+    "BusinessAddress": "VARCHAR",
+    "RestaurantInspectionID": "BIGINT",
+    "IsSidewayCompliant": "VARCHAR",
+    "IsRoadwayCompliant": "VARCHAR",
+    "SkippedReason": "VARCHAR",
+    "InspectedOn": "TIMESTAMP",
+    "AgencyCode": "VARCHAR",
+    "Postcode": "BIGINT",
+    "Latitude": "DOUBLE",
+    "Longitude": "DOUBLE",
+    "CommunityBoard": "BIGINT",
+    "CouncilDistrict": "BIGINT",
+    "CensusTract": "BIGINT",
+    "BIN": "BIGINT",
+    "BBL": "BIGINT",
+    "NTA": "VARCHAR",
+}
+# InspectedOn looks like "2021 Dec 20 04:06:58 PM".
+RESTAURANT_CSV_TIMESTAMP_FORMAT = "%Y %b %d %I:%M:%S %p"
+
+# Distances are measured on an equirectangular projection around NYC: at this
+# latitude a degree of longitude is only ~0.76 of a degree of latitude, so raw
+# degree deltas would favour stations to the east and west.
+EARTH_RADIUS_M = 6_371_008.8
+PROJECTION_REF_LAT = 40.7
+
+# Side of one cell (in meters) of the uniform grid the nearest-station search
+# buckets subway complexes into. Most restaurants have a station within one cell.
+STATION_GRID_CELL_M = 1000
+
+# How many nearest station complexes restaurant_nearest_stations keeps per
+# restaurant; the first is the one restaurants_with_station is assigned.
+NEAREST_STATIONS_K = 3
+
+# Physical row order of the tables served per cuisine. Each cuisine's rows
+# sit in a few adjacent row groups, so a filter against a typed literal
+# (cuisine = 'Thai'::cuisine_label, as export_cuisine_shards uses) skips the
+# rest of the table on the min/max zone maps. A plain string literal casts the
+# column to VARCHAR and scans every row; the dashboard's interaction filters
+# are plain strings, so they do not benefit.
+CUISINE_CLUSTERED_TABLES = {
+    "restaurants_with_station": ["cuisine", "complex_id", "restaurant_id"],
+    "station_cuisine_counts": ["cuisine", "complex_id"],
+    "station_radius_counts": ["cuisine", "complex_id", "radius_m"],
+    "station_cuisine_rank": ["cuisine", "rank"],
+    "restaurant_markers": ["cuisine", "latitude", "longitude"],
+    "restaurant_clusters": ["cuisine", "zoom", "cell_y", "cell_x"],
+}
+
+# Decimal places restaurant_markers keeps of each coordinate; 1e-5 degrees is
+# about a meter, well below what a marker map can show.
+MARKER_COORD_DECIMALS = 5
+
+# With QUANTIZE_COORDS (--quantize-coords) the coordinates of the tables the
+# dashboard, shards and tiles read are stored as DECIMAL(8, 5): fixed-point
+# 1e-5 degree steps held in an int32, which DuckDB and Parquet then pack with
+# frame-of-reference and bit-packing. Readers still see degrees.
+QUANTIZE_COORDS = False
+QUANTIZED_COORD_TYPE = f"DECIMAL(8, {MARKER_COORD_DECIMALS})"
+
+# Zoom levels restaurant_clusters covers, and the side (in screen pixels) of
+# the Web Mercator grid cell each cluster stands for at its zoom.
+CLUSTER_MIN_ZOOM = 9
+CLUSTER_MAX_ZOOM = 16
+CLUSTER_CELL_PX = 64
+
+# How many top stations per cuisine station_cuisine_rank keeps. The dashboard
+# filters on the stored rank, so any top-N up to this needs no window sort.
+STATION_RANK_TOP_N = 10
+
+# Walking radii (in meters) for the per-station restaurant counts in
+# station_radius_counts, which unlike station_cuisine_counts count every
+# restaurant in reach, not just those whose nearest station it is.
+STATION_RADII_M = [250, 500, 1000]
+
 # Each tuple is (cuisine_label, regex_pattern). Order matters: first match wins.
 CUISINES = [
     # ── Specific food type (before Italian so pizza shops get their own category) ──
@@ -265,17 +388,680 @@ CUISINES = [
 ]
 
 
-def _build_cuisine_case_sql():
-    """Generate the SQL CASE statement from the CUISINES list."""
-    clauses = []
-    for label, pattern in CUISINES:
-        escaped = label.replace("'", "''")
-        clauses.append(
-            f"WHEN regexp_matches(LOWER(d.RestaurantName), '{pattern}') "
-            f"THEN '{escaped}'"
+def _split_branches(pattern):
+    """Split a regex on its top-level `|` alternation."""
+    branches, depth, start, i = [], 0, 0, 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 1
+        elif c == "[":
+            i = pattern.index("]", i + 2 if pattern[i + 1] in "]^" else i + 1)
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            branches.append(pattern[start:i])
+            start = i + 1
+        i += 1
+    branches.append(pattern[start:])
+    return branches
+
+
+def _required_literal(branch):
+    """Longest run of characters that every match of `branch` must contain.
+
+    Understands the subset of regex syntax CUISINES uses: escapes, groups,
+    character classes, `.` and the ?, *, + and {} quantifiers. Anything that
+    is not a mandatory plain character ends the current run.
+    """
+    runs, run, i = [], "", 0
+    while i < len(branch):
+        c = branch[i]
+        if c == "\\":
+            escaped = branch[i + 1]
+            token = None if escaped.isalnum() else escaped
+            i += 2
+        elif c == "(":
+            depth, i = 1, i + 1
+            while depth:
+                if branch[i] == "\\":
+                    i += 1
+                elif branch[i] in "()":
+                    depth += 1 if branch[i] == "(" else -1
+                i += 1
+            token = None
+        elif c == "[":
+            i = branch.index("]", i + 2 if branch[i + 1] in "]^" else i + 1) + 1
+            token = None
+        elif c in ".^$":
+            token, i = None, i + 1
+        else:
+            token, i = c, i + 1
+
+        quantifier = branch[i:i + 1]
+        if quantifier in ("?", "*", "{"):
+            i = branch.index("}", i) + 1 if quantifier == "{" else i + 1
+            token = None
+        elif quantifier == "+":
+            i += 1
+            run += token or ""
+            token = None
+
+        if token is None:
+            runs.append(run)
+            run = ""
+        else:
+            run += token
+    runs.append(run)
+    return max(runs, key=len)
+
+
+def _compile_cuisine_classifier(cuisines=CUISINES, ngram=3):
+    """Compile CUISINES into a classifier with a literal prefilter index.
+
+    Every branch of every rule needs some literal keyword to match ("sushi",
+    "chin" for `chin(a|ese)`, ...). Each branch is indexed under one n-gram
+    of that literal, so a name is only tested against the rules whose
+    literals it actually contains, plus any rule with a branch too short to
+    index. Candidates are then run in list order, so the result is still the
+    first rule that matches. Patterns are compiled with re.ASCII so \\b and
+    \\w follow DuckDB's (RE2) semantics.
+
+    Returns a function mapping a restaurant name to the index of its rule in
+    `cuisines`, or None when no rule matches.
+    """
+    rules = [re.compile(pattern, re.ASCII) for _, pattern in cuisines]
+    index = {}
+    unindexed = []
+    for rule_index, (_, pattern) in enumerate(cuisines):
+        literals = [_required_literal(b) for b in _split_branches(pattern)]
+        if min(len(literal) for literal in literals) < ngram:
+            unindexed.append(rule_index)
+            continue
+        for literal in literals:
+            index.setdefault(literal[:ngram], []).append((rule_index, literal))
+
+    def classify(name):
+        name = name.lower()
+        candidates = set(unindexed)
+        for i in range(len(name) - ngram + 1):
+            for rule_index, literal in index.get(name[i:i + ngram], ()):
+                if literal in name:
+                    candidates.add(rule_index)
+        for rule_index in sorted(candidates):
+            if rules[rule_index].search(name):
+                return rule_index
+        return None
+
+    return classify
+
+
+def profile_cuisine_rules(con, json_path=RULE_PROFILE_JSON):
+    """Evaluate every CUISINES rule on every regex-classified name and report.
+
+    For each rule records how many names it wins (first match), how many it
+    would also match but loses to an earlier rule (shadowed), and the total
+    time spent evaluating it. Names resolved by the lookup table are skipped
+    since no rule ever runs on them. The report is written to `json_path`
+    and to the cuisine_rule_profile table.
+    """
+    names = [row[0] for row in con.execute("""
+        SELECT normalized_name
+        FROM name_cuisine
+        ANTI JOIN (SELECT LOWER(TRIM(restaurant_name)) AS normalized_name FROM cuisine_lookup)
+            USING (normalized_name)
+    """).fetchall()]
+    rules = [re.compile(pattern, re.ASCII) for _, pattern in CUISINES]
+    matches = [0] * len(rules)
+    shadowed = [0] * len(rules)
+    seconds = [0.0] * len(rules)
+    for name in names:
+        won = False
+        for rule_index, rule in enumerate(rules):
+            start = time.perf_counter()
+            hit = rule.search(name)
+            seconds[rule_index] += time.perf_counter() - start
+            if hit is None:
+                continue
+            if won:
+                shadowed[rule_index] += 1
+            else:
+                matches[rule_index] += 1
+                won = True
+
+    profile = [
+        {
+            "rule_index": i,
+            "cuisine": label,
+            "matches": matches[i],
+            "shadowed": shadowed[i],
+            "eval_seconds": round(seconds[i], 6),
+        }
+        for i, (label, _) in enumerate(CUISINES)
+    ]
+    with open(json_path, "w") as f:
+        json.dump({"names_profiled": len(names), "rules": profile}, f, indent=2)
+    _load_rows(
+        con, "rule_profile",
+        {"rule_index": "INTEGER", "cuisine": "VARCHAR", "matches": "BIGINT",
+         "shadowed": "BIGINT", "eval_seconds": "DOUBLE"},
+        (tuple(row.values()) for row in profile),
+    )
+    con.execute("CREATE OR REPLACE TABLE cuisine_rule_profile AS SELECT * FROM rule_profile")
+    return profile
+
+
+def _lookup_fingerprint():
+    """Hash of the cuisine lookup TSV contents."""
+    with open(CUISINE_LOOKUP_TSV, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _ruleset_fingerprint():
+    """Hash of everything that decides a name's cuisine: CUISINES and the lookup TSV."""
+    digest = hashlib.sha256(json.dumps(CUISINES).encode("utf-8"))
+    digest.update(_lookup_fingerprint().encode("ascii"))
+    return digest.hexdigest()
+
+
+def _write_cuisine_rules(con):
+    """Record the CUISINES list and lookup hash the database was classified with."""
+    _load_rows(
+        con, "current_rules",
+        {"rule_index": "INTEGER", "cuisine": "VARCHAR", "pattern": "VARCHAR"},
+        ((i, label, pattern) for i, (label, pattern) in enumerate(CUISINES)),
+    )
+    con.execute("CREATE OR REPLACE TABLE cuisine_rules AS SELECT * FROM current_rules")
+    con.execute("""
+        CREATE OR REPLACE TABLE build_info (key VARCHAR PRIMARY KEY, value VARCHAR)
+    """)
+    con.execute(
+        "INSERT INTO build_info VALUES ('lookup_fingerprint', ?)",
+        [_lookup_fingerprint()],
+    )
+
+
+def _write_cuisine_enum(con):
+    """Create the cuisine_label ENUM and the cuisines dimension table.
+
+    Labels come from CUISINES, the lookup TSV and 'Unclassified', in
+    alphabetical order so ORDER BY cuisine still sorts by name. Derived tables
+    store cuisine as this ENUM, a one-byte code; compare against a typed
+    literal (cuisine = 'Thai'::cuisine_label) to filter on the code directly.
+    """
+    con.execute("""
+        CREATE OR REPLACE TYPE cuisine_label AS ENUM (
+            SELECT cuisine FROM (
+                SELECT cuisine FROM cuisine_rules
+                UNION
+                SELECT cuisine FROM cuisine_lookup WHERE cuisine IS NOT NULL
+                UNION
+                SELECT 'Unclassified'
+            )
+            ORDER BY cuisine
         )
-    body = "\n                ".join(clauses)
-    return f"CASE\n                {body}\n                ELSE NULL\n            END"
+    """)
+    con.execute("""
+        CREATE OR REPLACE TABLE cuisines AS
+        SELECT enum_code(cuisine) AS cuisine_id, cuisine
+        FROM (SELECT unnest(enum_range(NULL::cuisine_label))::cuisine_label AS cuisine)
+        ORDER BY cuisine_id
+    """)
+
+
+def _lookup_cuisine_sql():
+    """Lookup TSV entries by normalized name; the first entry in file order wins."""
+    return """
+        SELECT
+            LOWER(TRIM(restaurant_name)) AS normalized_name,
+            min_by(cuisine, rowid) AS cuisine
+        FROM cuisine_lookup
+        GROUP BY normalized_name
+    """
+
+
+def _open_cuisine_cache(con, cache_path, fingerprint):
+    """Attach the sidecar cache and return the qualified name of its table.
+
+    With cache_path=None an empty temp table stands in for the sidecar.
+    """
+    columns = """
+        normalized_name VARCHAR,
+        ruleset_fingerprint VARCHAR,
+        rule_index INTEGER,
+        cuisine VARCHAR
+    """
+    if cache_path is None:
+        con.execute(f"CREATE OR REPLACE TEMP TABLE cuisine_cache ({columns})")
+        return "temp.cuisine_cache"
+
+    con.execute(f"ATTACH '{cache_path}' AS cache")
+    cache_columns = {
+        row[0] for row in con.execute("""
+            SELECT column_name FROM duckdb_columns()
+            WHERE database_name = 'cache' AND table_name = 'cuisine_cache'
+        """).fetchall()
+    }
+    if cache_columns and "rule_index" not in cache_columns:
+        # Written before rule indexes were tracked; cheaper to start over.
+        con.execute("DROP TABLE cache.cuisine_cache")
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS cache.cuisine_cache (
+            {columns},
+            PRIMARY KEY (normalized_name, ruleset_fingerprint)
+        )
+    """)
+    # Entries for older rulesets can never be hit again.
+    con.execute(
+        "DELETE FROM cache.cuisine_cache WHERE ruleset_fingerprint != ?",
+        [fingerprint],
+    )
+    return "cache.cuisine_cache"
+
+
+def _classify_names(con, cache_path):
+    """Build name_cuisine (normalized_name, rule_index, cuisine) for deduped_restaurants.
+
+    Chains repeat the same name many times, so the lookup join and the regex
+    classifier run once per distinct normalized name. Results are kept in the
+    sidecar cache at `cache_path` under the current ruleset fingerprint, and
+    only names the cache has not seen are classified. Pass cache_path=None
+    to classify everything from scratch. rule_index points into cuisine_rules
+    and is NULL for names resolved by the lookup table or left unclassified.
+    """
+    con.execute("""
+        CREATE TEMP TABLE distinct_names AS
+        SELECT DISTINCT LOWER(TRIM(RestaurantName)) AS normalized_name
+        FROM deduped_restaurants
+        WHERE RestaurantName IS NOT NULL
+    """)
+
+    fingerprint = _ruleset_fingerprint()
+    cache = _open_cuisine_cache(con, cache_path, fingerprint)
+
+    con.execute(f"""
+        CREATE TEMP TABLE new_names AS
+        SELECT n.normalized_name
+        FROM distinct_names n
+        ANTI JOIN (
+            SELECT normalized_name FROM {cache} WHERE ruleset_fingerprint = ?
+        ) c USING (normalized_name)
+    """, [fingerprint])
+
+    con.execute(f"CREATE TEMP TABLE lookup_cuisine AS {_lookup_cuisine_sql()}")
+    names = con.execute("""
+        SELECT normalized_name
+        FROM new_names
+        ANTI JOIN lookup_cuisine USING (normalized_name)
+    """).fetchall()
+    if names:
+        classify = _compile_cuisine_classifier()
+        _load_rows(
+            con, "regex_cuisine",
+            {"normalized_name": "VARCHAR", "rule_index": "INTEGER"},
+            ((name, classify(name)) for (name,) in names),
+        )
+    else:
+        con.execute(
+            "CREATE TEMP TABLE regex_cuisine (normalized_name VARCHAR, rule_index INTEGER)"
+        )
+
+    con.execute(f"""
+        INSERT INTO {cache}
+        SELECT
+            n.normalized_name,
+            ? AS ruleset_fingerprint,
+            r.rule_index,
+            COALESCE(l.cuisine, cr.cuisine, 'Unclassified') AS cuisine
+        FROM new_names n
+        LEFT JOIN lookup_cuisine l USING (normalized_name)
+        LEFT JOIN regex_cuisine r USING (normalized_name)
+        LEFT JOIN cuisine_rules cr USING (rule_index)
+    """, [fingerprint])
+    con.execute(f"""
+        CREATE OR REPLACE TABLE name_cuisine AS
+        SELECT n.normalized_name, c.rule_index, CAST(c.cuisine AS cuisine_label) AS cuisine
+        FROM distinct_names n
+        JOIN {cache} c
+          ON c.normalized_name = n.normalized_name
+         AND c.ruleset_fingerprint = ?
+    """, [fingerprint])
+
+    new_count = con.execute("SELECT COUNT(*) FROM new_names").fetchone()[0]
+    total = con.execute("SELECT COUNT(*) FROM name_cuisine").fetchone()[0]
+    print(f"  {total - new_count:,} of {total:,} distinct names from cache, "
+          f"{len(names):,} classified by regex")
+    if cache_path is not None:
+        con.execute("DETACH cache")
+
+
+def _load_rows(con, table, columns, rows):
+    """Bulk-load Python rows into a new temp table through a scratch CSV file.
+
+    `columns` maps column names to DuckDB types in row order; None values are
+    loaded as NULL. Going through read_csv keeps large batches fast without
+    pulling in numpy or pandas.
+    """
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".csv", newline="", encoding="utf-8", delete=False,
+    ) as f:
+        writer = csv.writer(f)
+        for row in rows:
+            writer.writerow(r"\N" if value is None else value for value in row)
+    try:
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE {table} AS
+            SELECT * FROM read_csv('{f.name}', header=false, columns={columns!r},
+                nullstr='\\N')
+        """)
+    finally:
+        os.remove(f.name)
+
+
+def _projected_xy_sql(lat, lon):
+    """SQL expressions for the (x, y) position in meters of the point `lat`, `lon`."""
+    scale = EARTH_RADIUS_M * math.pi / 180
+    x = f"({lon}) * {scale * math.cos(math.radians(PROJECTION_REF_LAT))}"
+    y = f"({lat}) * {scale}"
+    return x, y
+
+
+def _assign_nearest_stations(con, k=NEAREST_STATIONS_K, cell=STATION_GRID_CELL_M):
+    """Fill the temp table nearest_stations (restaurant_id, station_rank, complex_id, distance_m).
+
+    Stations are bucketed once into a uniform grid. Every pass joins the
+    still-unresolved restaurants against the stations in the block of cells
+    within `radius` cells of their own, all in one batched query. A restaurant
+    is resolved once its k-th best candidate is closer than the block edge,
+    since no station outside the block can beat it; the rest retry with a
+    doubled radius, until the block spans the station grid.
+    """
+    station_count = con.execute("SELECT COUNT(*) FROM subway_stations").fetchone()[0]
+    if station_count == 0:
+        raise ValueError("subway_stations is empty, cannot assign nearest stations")
+    k = min(k, station_count)
+
+    x, y = _projected_xy_sql("latitude", "longitude")
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE station_grid AS
+        SELECT
+            complex_id,
+            x,
+            y,
+            CAST(FLOOR(y / {cell}) AS INTEGER) AS cell_y,
+            CAST(FLOOR(x / {cell}) AS INTEGER) AS cell_x
+        FROM (
+            SELECT complex_id, {x} AS x, {y} AS y
+            FROM subway_stations
+        )
+    """)
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE pending_restaurants AS
+        SELECT
+            restaurant_id,
+            x,
+            y,
+            CAST(FLOOR(y / {cell}) AS INTEGER) AS cell_y,
+            CAST(FLOOR(x / {cell}) AS INTEGER) AS cell_x
+        FROM (
+            SELECT restaurant_id, {x} AS x, {y} AS y
+            FROM classified_restaurants
+        )
+    """)
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE nearest_stations (
+            restaurant_id BIGINT,
+            station_rank INTEGER,
+            complex_id BIGINT,
+            distance_m DOUBLE
+        )
+    """)
+
+    # Once the block spans the whole station grid, doubling again only
+    # grows station_cells; whatever is still pending (restaurants far outside
+    # the city, e.g. with a sign-flipped longitude) is compared against every
+    # station instead.
+    span = con.execute("""
+        SELECT greatest(max(cell_x) - min(cell_x), max(cell_y) - min(cell_y))
+        FROM station_grid
+    """).fetchone()[0]
+    radius = 1
+    while radius <= span and _pending_restaurant_count(con):
+        _resolve_nearest_candidates(con, k, f"""
+            (
+                -- Each station copied into every cell whose block reaches it.
+                SELECT
+                    s.complex_id,
+                    s.x,
+                    s.y,
+                    s.cell_y + dy.dy AS cell_y,
+                    s.cell_x + dx.dx AS cell_x
+                FROM station_grid s
+                CROSS JOIN range(-{radius}, {radius} + 1) dy(dy)
+                CROSS JOIN range(-{radius}, {radius} + 1) dx(dx)
+            ) s USING (cell_y, cell_x)
+        """, f"best[{k}].dist2 <= {(radius * cell) ** 2}")
+        radius *= 2
+    if _pending_restaurant_count(con):
+        _resolve_nearest_candidates(con, k, "station_grid s ON true", "true")
+
+
+def _pending_restaurant_count(con):
+    return con.execute("SELECT COUNT(*) FROM pending_restaurants").fetchone()[0]
+
+
+def _resolve_nearest_candidates(con, k, station_join, resolved):
+    """Move pending restaurants whose k nearest stations are certain into nearest_stations.
+
+    `station_join` is the JOIN clause pairing pending_restaurants p with
+    candidate stations s; `resolved` is the condition on a restaurant's k best
+    candidates under which no station outside the join can beat them.
+    """
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE nearest_candidates AS
+        WITH candidates AS (
+            SELECT
+                p.restaurant_id,
+                s.complex_id,
+                (p.x - s.x)*(p.x - s.x) + (p.y - s.y)*(p.y - s.y) AS dist2
+            FROM pending_restaurants p
+            JOIN {station_join}
+        ),
+        best AS (
+            -- The k closest, ties broken by complex_id, in order.
+            SELECT
+                restaurant_id,
+                min({{'dist2': dist2, 'complex_id': complex_id}}, {k}) AS best
+            FROM candidates
+            GROUP BY restaurant_id
+            HAVING len(best) = {k} AND {resolved}
+        )
+        SELECT
+            restaurant_id,
+            generate_subscripts(best, 1) AS station_rank,
+            unnest(best).complex_id AS complex_id,
+            SQRT(unnest(best).dist2) AS distance_m
+        FROM best
+    """)
+    con.execute("INSERT INTO nearest_stations SELECT * FROM nearest_candidates")
+    con.execute("""
+        DELETE FROM pending_restaurants
+        WHERE restaurant_id IN (SELECT restaurant_id FROM nearest_candidates)
+    """)
+
+
+def _count_within_radii(con, restaurants, stations, radii=STATION_RADII_M):
+    """Fill the temp table radius_counts (complex_id, radius_m, cuisine, restaurant_count).
+
+    `restaurants` and `stations` are relations with latitude and longitude
+    (plus cuisine and complex_id). Restaurants are bucketed into a grid whose
+    cell is the largest radius, so every pair within reach lies in the 3x3
+    block around the station's cell and one equi-join finds all of them.
+    """
+    cell = max(radii)
+    x, y = _projected_xy_sql("latitude", "longitude")
+    radius_values = ", ".join(f"({r})" for r in sorted(radii))
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE radius_counts AS
+        WITH restaurant_grid AS (
+            SELECT
+                cuisine,
+                x,
+                y,
+                CAST(FLOOR(y / {cell}) AS INTEGER) AS cell_y,
+                CAST(FLOOR(x / {cell}) AS INTEGER) AS cell_x
+            FROM (SELECT cuisine, {x} AS x, {y} AS y FROM {restaurants})
+        ),
+        station_cells AS (
+            SELECT
+                complex_id,
+                x,
+                y,
+                CAST(FLOOR(y / {cell}) AS INTEGER) + dy.dy AS cell_y,
+                CAST(FLOOR(x / {cell}) AS INTEGER) + dx.dx AS cell_x
+            FROM (SELECT complex_id, {x} AS x, {y} AS y FROM {stations})
+            CROSS JOIN range(-1, 2) dy(dy)
+            CROSS JOIN range(-1, 2) dx(dx)
+        ),
+        in_reach AS (
+            SELECT
+                s.complex_id,
+                r.cuisine,
+                (r.x - s.x)*(r.x - s.x) + (r.y - s.y)*(r.y - s.y) AS dist2
+            FROM restaurant_grid r
+            JOIN station_cells s USING (cell_y, cell_x)
+            WHERE (r.x - s.x)*(r.x - s.x) + (r.y - s.y)*(r.y - s.y) <= {cell * cell}
+        )
+        SELECT complex_id, radius_m, cuisine, COUNT(*) AS restaurant_count
+        FROM in_reach
+        JOIN (VALUES {radius_values}) radii(radius_m) ON dist2 <= radius_m * radius_m
+        GROUP BY complex_id, radius_m, cuisine
+    """)
+
+
+def verify_nearest_stations(con):
+    """Check restaurant_nearest_stations against a brute-force LATERAL search.
+
+    Returns the number of restaurants where any stored distance_m is more than
+    a millimetre off the same-ranked station the exhaustive search finds. Ties
+    count as matches.
+    """
+    restaurant_x, restaurant_y = _projected_xy_sql("r.latitude", "r.longitude")
+    station_x, station_y = _projected_xy_sql("latitude", "longitude")
+    return con.execute(f"""
+        WITH exhaustive AS (
+            SELECT r.restaurant_id, b.station_rank, b.distance_m
+            FROM classified_restaurants r,
+            LATERAL (
+                SELECT
+                    row_number() OVER (ORDER BY distance_m) AS station_rank,
+                    distance_m
+                FROM (
+                    SELECT
+                        SQRT(({restaurant_x} - {station_x})*({restaurant_x} - {station_x})
+                             + ({restaurant_y} - {station_y})*({restaurant_y} - {station_y}))
+                            AS distance_m
+                    FROM subway_stations
+                    ORDER BY distance_m
+                    LIMIT {NEAREST_STATIONS_K}
+                )
+            ) b
+        )
+        SELECT COUNT(DISTINCT e.restaurant_id)
+        FROM exhaustive e
+        LEFT JOIN restaurant_nearest_stations n USING (restaurant_id, station_rank)
+        WHERE n.distance_m IS NULL OR ABS(n.distance_m - e.distance_m) > 0.001
+    """).fetchone()[0]
+
+
+def _peak_rss_bytes():
+    """Peak resident set size of this process so far, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@contextlib.contextmanager
+def _timed_stage(con, stats, name):
+    """Record wall time, DuckDB memory and peak RSS of one build stage in `stats`."""
+    start = time.perf_counter()
+    yield
+    duckdb_memory = con.execute(
+        "SELECT SUM(memory_usage_bytes) FROM duckdb_memory()"
+    ).fetchone()[0]
+    stats.append({
+        "stage": name,
+        "skipped": False,
+        "seconds": round(time.perf_counter() - start, 4),
+        "duckdb_memory_bytes": int(duckdb_memory or 0),
+        "peak_rss_bytes": _peak_rss_bytes(),
+    })
+
+
+def measure_model_payloads(con, project_path=VISIVO_PROJECT_YML):
+    """Rows, columns and exported size of every SQL model in the Visivo project.
+
+    Each model's result is written as Parquet and as JSON to a scratch
+    directory to measure what a built dashboard has to ship. Returns None
+    when PyYAML is not installed.
+    """
+    if yaml is None:
+        return None
+    with open(project_path) as f:
+        project = yaml.safe_load(f)
+    payloads = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for model in project.get("models", []):
+            sql = model.get("sql")
+            if not sql or "${" in sql:
+                continue
+            parquet_path = os.path.join(tmp, "model.parquet")
+            json_path = os.path.join(tmp, "model.json")
+            con.execute(f"COPY ({sql}) TO '{parquet_path}' (FORMAT parquet)")
+            con.execute(f"COPY ({sql}) TO '{json_path}' (FORMAT json, ARRAY true)")
+            rows = con.execute(f"SELECT COUNT(*) FROM ({sql})").fetchone()[0]
+            columns = len(con.execute(f"SELECT * FROM ({sql}) LIMIT 0").description)
+            payloads.append({
+                "model": model["name"],
+                "rows": rows,
+                "columns": columns,
+                "parquet_bytes": os.path.getsize(parquet_path),
+                "json_bytes": os.path.getsize(json_path),
+            })
+    return payloads
+
+
+def _write_build_report(con, stats, json_path, payloads=None):
+    """Write per-stage stats to `json_path` and the build_stats table.
+
+    Model payload sizes, if measured, go to the report and the model_payloads table.
+    """
+    with open(json_path, "w") as f:
+        json.dump({
+            "database": DB_PATH,
+            "total_seconds": round(sum(stage["seconds"] for stage in stats), 4),
+            "stages": stats,
+            "model_payloads": payloads,
+        }, f, indent=2)
+    _load_rows(
+        con, "stage_stats",
+        {"stage": "VARCHAR", "skipped": "BOOLEAN", "seconds": "DOUBLE",
+         "duckdb_memory_bytes": "BIGINT", "peak_rss_bytes": "BIGINT"},
+        (tuple(stage.values()) for stage in stats),
+    )
+    con.execute("CREATE OR REPLACE TABLE build_stats AS SELECT * FROM stage_stats")
+    if payloads is not None:
+        _load_rows(
+            con, "payload_stats",
+            {"model": "VARCHAR", "rows": "BIGINT", "columns": "INTEGER",
+             "parquet_bytes": "BIGINT", "json_bytes": "BIGINT"},
+            (tuple(payload.values()) for payload in payloads),
+        )
+        con.execute("CREATE OR REPLACE TABLE model_payloads AS SELECT * FROM payload_stats")
 
 
 def download_subway_data():
@@ -287,32 +1073,108 @@ def download_subway_data():
     print(f"Downloaded to {SUBWAY_CSV}")
 
 
-def build_database():
-    if os.path.exists(DB_PATH):
-        os.remove(DB_PATH)
+@contextlib.contextmanager
+def _build_lock():
+    """Hold an exclusive lock on DB_PATH.lock for the duration of a build.
+
+    The OS drops the lock (flock, or msvcrt.locking on Windows) when its
+    holder exits, however it exits, so a crashed build never leaves a stale
+    lock behind. The file itself stays in place and records the holder's PID
+    for the error message.
+    """
+    lock_path = DB_PATH + ".lock"
+    with open(lock_path, "a+") as f:
+        try:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                # Lock a byte past the PID so other builds can still read it.
+                f.seek(1 << 20)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.seek(0)
+            owner = f.read().strip() or "unknown"
+            raise RuntimeError(f"another build (pid {owner}) holds {lock_path}") from None
+        f.truncate(0)
+        f.write(str(os.getpid()))
+        f.flush()
+        yield
+
+
+@contextlib.contextmanager
+def _staged_database(copy_existing):
+    """Yield a scratch database path that atomically replaces DB_PATH on success.
+
+    The scratch file (DB_PATH.tmp, on the same filesystem) starts as a copy of
+    DB_PATH (so unchanged stages can be skipped) or empty. Readers of DB_PATH
+    keep the old file until the rename.
+    If the body raises, DB_PATH is left untouched.
+    """
+    tmp_path = DB_PATH + ".tmp"
+    with _build_lock():
+        for leftover in (tmp_path, tmp_path + ".wal"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(leftover)
+        if copy_existing and os.path.exists(DB_PATH):
+            shutil.copyfile(DB_PATH, tmp_path)
+        try:
+            yield tmp_path
+        except BaseException:
+            for leftover in (tmp_path, tmp_path + ".wal"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(leftover)
+            raise
+        # A WAL left by a crashed writer of the old file would be replayed
+        # onto the new one.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(DB_PATH + ".wal")
+        os.replace(tmp_path, DB_PATH)
 
-    con = duckdb.connect(DB_PATH)
 
-    # ---- Load raw CSVs ----
+def _validate_database(con):
+    """Reject a build that is missing tables or left them empty; then checkpoint."""
+    tables = {row[0] for row in con.execute("SHOW TABLES").fetchall()}
+    for table in REQUIRED_TABLES:
+        if table not in tables:
+            raise RuntimeError(f"build produced no {table} table")
+        if con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0:
+            raise RuntimeError(f"build left {table} empty")
+    # Fold the WAL into the file so the renamed database is self-contained.
+    con.execute("CHECKPOINT")
+
+
+# ---- Build stages ----
+# Each stage reads the files and upstream tables it declares and (re)creates
+# its output tables. build_database() skips a stage when the fingerprint of
+# its inputs matches the one recorded in build_manifest by the last run.
+
+def _stage_load_restaurants(con, options):
     print("Loading restaurant CSV...")
     con.execute(f"""
-        CREATE TABLE raw_restaurants AS
-        SELECT * FROM read_csv_auto('{RESTAURANT_CSV}')
+        CREATE OR REPLACE TABLE raw_restaurants AS
+        SELECT * FROM read_csv('{RESTAURANT_CSV}',
+            auto_detect=false, header=true, delim=',', quote='"', escape='"',
+            columns={RESTAURANT_CSV_COLUMNS!r},
+            timestampformat='{RESTAURANT_CSV_TIMESTAMP_FORMAT}')
     """)
     row_count = con.execute("SELECT COUNT(*) FROM raw_restaurants").fetchone()[0]
     print(f"  Loaded {row_count:,} raw restaurant rows")
 
+
+def _stage_load_subway(con, options):
     print("Loading subway CSV...")
     con.execute(f"""
-        CREATE TABLE raw_subway AS
+        CREATE OR REPLACE TABLE raw_subway AS
         SELECT * FROM read_csv_auto('{SUBWAY_CSV}')
     """)
     row_count = con.execute("SELECT COUNT(*) FROM raw_subway").fetchone()[0]
     print(f"  Loaded {row_count:,} raw subway rows")
 
+
+def _stage_load_cuisine_lookup(con, options):
     print("Loading cuisine lookup table...")
     con.execute(f"""
-        CREATE TABLE cuisine_lookup AS
+        CREATE OR REPLACE TABLE cuisine_lookup AS
         SELECT
             column0 AS restaurant_name,
             column1 AS cuisine
@@ -322,10 +1184,11 @@ def build_database():
     lookup_count = con.execute("SELECT COUNT(*) FROM cuisine_lookup").fetchone()[0]
     print(f"  Loaded {lookup_count:,} cuisine lookup entries")
 
-    # ---- Deduplicate subway stations by Complex ID ----
+
+def _stage_subway_dedupe(con, options):
     print("Deduplicating subway stations by Complex ID...")
     con.execute("""
-        CREATE TABLE subway_stations AS
+        CREATE OR REPLACE TABLE subway_stations AS
         SELECT
             "Complex ID" AS complex_id,
             FIRST("Stop Name") AS stop_name,
@@ -338,94 +1201,504 @@ def build_database():
     station_count = con.execute("SELECT COUNT(*) FROM subway_stations").fetchone()[0]
     print(f"  {station_count:,} unique station complexes")
 
-    # ---- Deduplicate restaurants and classify cuisines ----
-    cuisine_case = _build_cuisine_case_sql()
-    print("Deduplicating restaurants and classifying cuisines...")
-    con.execute(f"""
-        CREATE TABLE classified_restaurants AS
-        WITH deduped AS (
-            SELECT *,
-                ROW_NUMBER() OVER (
-                    PARTITION BY RestaurantName, BusinessAddress
-                    ORDER BY InspectedOn DESC
-                ) AS rn
+
+def _stage_restaurant_dedupe(con, options):
+    print("Deduplicating restaurants...")
+    con.execute("""
+        CREATE OR REPLACE TABLE deduped_restaurants AS
+        SELECT RestaurantName, BusinessAddress, latest.*
+        FROM (
+            -- Latest inspection per restaurant, ties broken by inspection ID.
+            -- A struct with a NULL field sorts above every value, so undated
+            -- inspections are ranked as the oldest instead.
+            SELECT
+                RestaurantName,
+                BusinessAddress,
+                arg_max(
+                    {
+                        'InspectedOn': InspectedOn,
+                        'Borough': Borough,
+                        'Postcode': Postcode,
+                        'Latitude': Latitude,
+                        'Longitude': Longitude,
+                    },
+                    (COALESCE(InspectedOn, '-infinity'::TIMESTAMP), RestaurantInspectionID)
+                ) AS latest
             FROM raw_restaurants
             WHERE Latitude IS NOT NULL
               AND Longitude IS NOT NULL
-              AND CAST(Latitude AS DOUBLE) != 0
-              AND CAST(Longitude AS DOUBLE) != 0
+              AND Latitude != 0
+              AND Longitude != 0
+            GROUP BY RestaurantName, BusinessAddress
         )
+    """)
+    total = con.execute("SELECT COUNT(*) FROM deduped_restaurants").fetchone()[0]
+    print(f"  {total:,} deduplicated restaurants")
+
+
+def _stage_classification(con, options):
+    print("Classifying cuisines...")
+    _write_cuisine_rules(con)
+    _write_cuisine_enum(con)
+    _classify_names(con, options["cache_path"])
+    con.execute("""
+        CREATE OR REPLACE TABLE classified_restaurants AS
         SELECT
+            -- Stable for a given input, unlike the rowid of the hash aggregate.
+            row_number() OVER (ORDER BY d.RestaurantName, d.BusinessAddress) AS restaurant_id,
             d.RestaurantName AS restaurant_name,
             d.BusinessAddress AS address,
             d.Borough AS borough,
             d.Postcode AS postcode,
-            CAST(d.Latitude AS DOUBLE) AS latitude,
-            CAST(d.Longitude AS DOUBLE) AS longitude,
-            COALESCE(
-                cl.cuisine,
-                {cuisine_case},
-                'Unclassified'
-            ) AS cuisine
-        FROM deduped d
-        LEFT JOIN cuisine_lookup cl
-            ON LOWER(TRIM(d.RestaurantName)) = LOWER(TRIM(cl.restaurant_name))
-        WHERE d.rn = 1
+            d.Latitude AS latitude,
+            d.Longitude AS longitude,
+            COALESCE(nc.cuisine, 'Unclassified')::cuisine_label AS cuisine
+        FROM deduped_restaurants d
+        LEFT JOIN name_cuisine nc
+            ON nc.normalized_name = LOWER(TRIM(d.RestaurantName))
     """)
 
     total = con.execute("SELECT COUNT(*) FROM classified_restaurants").fetchone()[0]
     classified = con.execute(
         "SELECT COUNT(*) FROM classified_restaurants WHERE cuisine != 'Unclassified'"
     ).fetchone()[0]
-    print(f"  {total:,} deduplicated restaurants, {classified:,} classified ({classified*100//total}%)")
+    print(f"  {total:,} restaurants, {classified:,} classified ({classified*100//total}%)")
+
 
-    # ---- Nearest station via LATERAL join ----
-    print("Computing nearest subway station for each restaurant...")
+def _stage_nearest_station(con, options):
+    print(f"Computing {NEAREST_STATIONS_K} nearest subway stations for each restaurant...")
+    _assign_nearest_stations(con)
     con.execute("""
-        CREATE TABLE restaurants_with_station AS
+        CREATE OR REPLACE TABLE restaurant_nearest_stations AS
+        SELECT restaurant_id, station_rank, complex_id, distance_m
+        FROM nearest_stations
+        ORDER BY restaurant_id, station_rank
+    """)
+    con.execute(f"""
+        CREATE OR REPLACE TABLE restaurants_with_station AS
         SELECT
+            r.restaurant_id,
             r.restaurant_name,
             r.address,
             r.borough,
             r.postcode,
-            r.latitude,
-            r.longitude,
+            {_coord_sql("r.latitude")} AS latitude,
+            {_coord_sql("r.longitude")} AS longitude,
             r.cuisine,
+            n.complex_id,
             s.stop_name AS station_name,
-            s.latitude AS station_lat,
-            s.longitude AS station_lon,
-            s.all_routes AS station_routes
-        FROM classified_restaurants r,
-        LATERAL (
-            SELECT stop_name, latitude, longitude, all_routes, complex_id
-            FROM subway_stations
-            ORDER BY (r.latitude - latitude)*(r.latitude - latitude)
-                   + (r.longitude - longitude)*(r.longitude - longitude)
-            LIMIT 1
-        ) s
+            {_coord_sql("s.latitude")} AS station_lat,
+            {_coord_sql("s.longitude")} AS station_lon,
+            s.all_routes AS station_routes,
+            n.distance_m
+        FROM classified_restaurants r
+        JOIN restaurant_nearest_stations n
+            ON n.restaurant_id = r.restaurant_id AND n.station_rank = 1
+        JOIN subway_stations s ON s.complex_id = n.complex_id
+        ORDER BY {_cluster_order("restaurants_with_station")}
     """)
-
     rws_count = con.execute("SELECT COUNT(*) FROM restaurants_with_station").fetchone()[0]
     print(f"  {rws_count:,} restaurants with nearest station assigned")
 
-    # ---- Station cuisine summary ----
+
+def _coord_sql(expr, decimals=None):
+    """SQL for a stored coordinate: fixed-point under QUANTIZE_COORDS, else a DOUBLE."""
+    if QUANTIZE_COORDS:
+        return f"CAST(ROUND({expr}, {MARKER_COORD_DECIMALS}) AS {QUANTIZED_COORD_TYPE})"
+    if decimals is not None:
+        return f"ROUND({expr}, {decimals})"
+    return expr
+
+
+def _cluster_order(table):
+    return ", ".join(CUISINE_CLUSTERED_TABLES[table])
+
+
+def _recluster(con, table):
+    """Rewrite `table` in its CUISINE_CLUSTERED_TABLES order after in-place edits."""
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {table} AS
+        SELECT * FROM {table} ORDER BY {_cluster_order(table)}
+    """)
+
+
+def _stage_aggregation(con, options):
     print("Building station cuisine counts...")
-    con.execute("""
-        CREATE TABLE station_cuisine_counts AS
+    # Grouped on the integer key alone; station attributes are joined once
+    # per output row instead of being hashed for every restaurant.
+    con.execute(f"""
+        CREATE OR REPLACE TABLE station_cuisine_counts AS
         SELECT
-            station_name,
-            station_lat,
-            station_lon,
-            station_routes,
-            cuisine,
-            COUNT(*) AS restaurant_count
-        FROM restaurants_with_station
-        GROUP BY station_name, station_lat, station_lon, station_routes, cuisine
+            c.complex_id,
+            s.stop_name AS station_name,
+            s.latitude AS station_lat,
+            s.longitude AS station_lon,
+            s.all_routes AS station_routes,
+            c.cuisine,
+            c.restaurant_count
+        FROM (
+            SELECT complex_id, cuisine, COUNT(*) AS restaurant_count
+            FROM restaurants_with_station
+            GROUP BY complex_id, cuisine
+        ) c
+        JOIN subway_stations s USING (complex_id)
+        ORDER BY {_cluster_order("station_cuisine_counts")}
     """)
-
     scc_count = con.execute("SELECT COUNT(*) FROM station_cuisine_counts").fetchone()[0]
     print(f"  {scc_count:,} station-cuisine combinations")
 
+
+def _station_rank_sql():
+    """Top STATION_RANK_TOP_N stations per cuisine by restaurant count."""
+    return f"""
+        SELECT
+            * REPLACE (
+                {_coord_sql("station_lat")} AS station_lat,
+                {_coord_sql("station_lon")} AS station_lon
+            ),
+            row_number() OVER (
+                PARTITION BY cuisine ORDER BY restaurant_count DESC, complex_id
+            ) AS rank
+        FROM station_cuisine_counts
+        QUALIFY rank <= {STATION_RANK_TOP_N}
+    """
+
+
+def _stage_station_rank(con, options):
+    print(f"Ranking the top {STATION_RANK_TOP_N} stations per cuisine...")
+    con.execute(f"""
+        CREATE OR REPLACE TABLE station_cuisine_rank AS
+        {_station_rank_sql()}
+        ORDER BY {_cluster_order("station_cuisine_rank")}
+    """)
+    rank_count = con.execute("SELECT COUNT(*) FROM station_cuisine_rank").fetchone()[0]
+    print(f"  {rank_count:,} ranked station-cuisine rows")
+
+
+def _write_restaurant_markers(con):
+    """Serving table for the restaurants model: just what the marker map draws."""
+    con.execute(f"""
+        CREATE OR REPLACE TABLE restaurant_markers AS
+        SELECT
+            {_coord_sql("latitude", MARKER_COORD_DECIMALS)} AS latitude,
+            {_coord_sql("longitude", MARKER_COORD_DECIMALS)} AS longitude,
+            restaurant_name || ' - ' || address AS label,
+            cuisine
+        FROM restaurants_with_station
+        ORDER BY {_cluster_order("restaurant_markers")}
+    """)
+
+
+def _stage_serving(con, options):
+    print("Writing dashboard serving tables...")
+    _write_restaurant_markers(con)
+    marker_count = con.execute("SELECT COUNT(*) FROM restaurant_markers").fetchone()[0]
+    print(f"  {marker_count:,} restaurant markers")
+
+
+def _restaurant_clusters_sql():
+    """Count and centroid of restaurants per cuisine, zoom and grid cell.
+
+    Restaurants are binned once into cells at CLUSTER_MAX_ZOOM; a cell at
+    each lower zoom is the 2x2 block of the cells below it, so the coarser
+    levels come from shifting the small set of finest cells, not from the
+    restaurants again.
+    """
+    cells = (1 << CLUSTER_MAX_ZOOM) * 256 // CLUSTER_CELL_PX
+    return f"""
+        WITH finest AS (
+            SELECT
+                cuisine,
+                CAST(FLOOR((longitude + 180) / 360 * {cells}) AS BIGINT) AS cell_x,
+                CAST(FLOOR(
+                    (1 - LN(TAN(RADIANS(latitude)) + 1 / COS(RADIANS(latitude))) / PI()) / 2
+                    * {cells}
+                ) AS BIGINT) AS cell_y,
+                COUNT(*) AS restaurant_count,
+                -- Exact sums, so centroids do not depend on summation order.
+                SUM(CAST(latitude AS DECIMAL(18, 9))) AS sum_lat,
+                SUM(CAST(longitude AS DECIMAL(18, 9))) AS sum_lon
+            FROM restaurants_with_station
+            GROUP BY ALL
+        )
+        SELECT
+            cuisine,
+            CAST(zoom AS UTINYINT) AS zoom,
+            CAST(cell_x >> ({CLUSTER_MAX_ZOOM} - zoom) AS INTEGER) AS cell_x,
+            CAST(cell_y >> ({CLUSTER_MAX_ZOOM} - zoom) AS INTEGER) AS cell_y,
+            CAST(SUM(restaurant_count) AS INTEGER) AS restaurant_count,
+            {_coord_sql("SUM(sum_lat) / SUM(restaurant_count)", MARKER_COORD_DECIMALS)}
+                AS latitude,
+            {_coord_sql("SUM(sum_lon) / SUM(restaurant_count)", MARKER_COORD_DECIMALS)}
+                AS longitude
+        FROM finest
+        CROSS JOIN range({CLUSTER_MIN_ZOOM}, {CLUSTER_MAX_ZOOM + 1}) z(zoom)
+        GROUP BY ALL
+    """
+
+
+def _stage_clusters(con, options):
+    print(f"Clustering restaurants for zoom {CLUSTER_MIN_ZOOM}-{CLUSTER_MAX_ZOOM}...")
+    con.execute(f"""
+        CREATE OR REPLACE TABLE restaurant_clusters AS
+        {_restaurant_clusters_sql()}
+        ORDER BY {_cluster_order("restaurant_clusters")}
+    """)
+    cluster_count = con.execute("SELECT COUNT(*) FROM restaurant_clusters").fetchone()[0]
+    print(f"  {cluster_count:,} clusters")
+
+
+def _stage_radius_counts(con, options):
+    radii = ", ".join(map(str, STATION_RADII_M))
+    print(f"Counting restaurants within {radii} m of each station...")
+    _count_within_radii(con, "classified_restaurants", "subway_stations")
+    con.execute(f"""
+        CREATE OR REPLACE TABLE station_radius_counts AS
+        SELECT
+            c.complex_id,
+            s.stop_name AS station_name,
+            s.latitude AS station_lat,
+            s.longitude AS station_lon,
+            s.all_routes AS station_routes,
+            c.radius_m,
+            c.cuisine,
+            c.restaurant_count
+        FROM radius_counts c
+        JOIN subway_stations s USING (complex_id)
+        ORDER BY {_cluster_order("station_radius_counts")}
+    """)
+    src_count = con.execute("SELECT COUNT(*) FROM station_radius_counts").fetchone()[0]
+    print(f"  {src_count:,} station-radius-cuisine combinations")
+
+
+# `files` are hashed by content, `config` by value and the stage's code (its
+# `run` function and every module function it reaches) by source, and
+# `upstream` stages contribute their own fingerprints, so a change anywhere
+# up the chain re-runs every stage below it.
+BuildStage = collections.namedtuple(
+    "BuildStage", ["name", "run", "outputs", "files", "config", "upstream"],
+)
+
+BUILD_STAGES = [
+    BuildStage(
+        "load_restaurants", _stage_load_restaurants, ["raw_restaurants"],
+        files=lambda: [RESTAURANT_CSV],
+        config=lambda: [RESTAURANT_CSV_COLUMNS, RESTAURANT_CSV_TIMESTAMP_FORMAT],
+        upstream=[],
+    ),
+    BuildStage(
+        "load_subway", _stage_load_subway, ["raw_subway"],
+        files=lambda: [SUBWAY_CSV],
+        config=lambda: [],
+        upstream=[],
+    ),
+    BuildStage(
+        "load_cuisine_lookup", _stage_load_cuisine_lookup, ["cuisine_lookup"],
+        files=lambda: [CUISINE_LOOKUP_TSV],
+        config=lambda: [],
+        upstream=[],
+    ),
+    BuildStage(
+        "subway_dedupe", _stage_subway_dedupe, ["subway_stations"],
+        files=lambda: [],
+        config=lambda: [],
+        upstream=["load_subway"],
+    ),
+    BuildStage(
+        "restaurant_dedupe", _stage_restaurant_dedupe, ["deduped_restaurants"],
+        files=lambda: [],
+        config=lambda: [],
+        upstream=["load_restaurants"],
+    ),
+    BuildStage(
+        "classification", _stage_classification,
+        ["cuisine_rules", "build_info", "cuisines", "name_cuisine", "classified_restaurants"],
+        files=lambda: [],
+        config=lambda: [CUISINES],
+        upstream=["restaurant_dedupe", "load_cuisine_lookup"],
+    ),
+    BuildStage(
+        "nearest_station", _stage_nearest_station,
+        ["restaurant_nearest_stations", "restaurants_with_station"],
+        files=lambda: [],
+        config=lambda: [
+            EARTH_RADIUS_M, PROJECTION_REF_LAT, STATION_GRID_CELL_M, NEAREST_STATIONS_K,
+            CUISINE_CLUSTERED_TABLES, QUANTIZE_COORDS, QUANTIZED_COORD_TYPE,
+        ],
+        upstream=["classification", "subway_dedupe"],
+    ),
+    BuildStage(
+        "aggregation", _stage_aggregation, ["station_cuisine_counts"],
+        files=lambda: [],
+        config=lambda: [CUISINE_CLUSTERED_TABLES],
+        upstream=["nearest_station"],
+    ),
+    BuildStage(
+        "station_rank", _stage_station_rank, ["station_cuisine_rank"],
+        files=lambda: [],
+        config=lambda: [
+            STATION_RANK_TOP_N, CUISINE_CLUSTERED_TABLES, QUANTIZE_COORDS, QUANTIZED_COORD_TYPE,
+        ],
+        upstream=["aggregation"],
+    ),
+    BuildStage(
+        "serving", _stage_serving, ["restaurant_markers"],
+        files=lambda: [],
+        config=lambda: [
+            MARKER_COORD_DECIMALS, CUISINE_CLUSTERED_TABLES, QUANTIZE_COORDS,
+            QUANTIZED_COORD_TYPE,
+        ],
+        upstream=["nearest_station"],
+    ),
+    BuildStage(
+        "clusters", _stage_clusters, ["restaurant_clusters"],
+        files=lambda: [],
+        config=lambda: [
+            CLUSTER_MIN_ZOOM, CLUSTER_MAX_ZOOM, CLUSTER_CELL_PX, MARKER_COORD_DECIMALS,
+            CUISINE_CLUSTERED_TABLES, QUANTIZE_COORDS, QUANTIZED_COORD_TYPE,
+        ],
+        upstream=["nearest_station"],
+    ),
+    BuildStage(
+        "radius_counts", _stage_radius_counts, ["station_radius_counts"],
+        files=lambda: [],
+        config=lambda: [
+            EARTH_RADIUS_M, PROJECTION_REF_LAT, STATION_RADII_M, CUISINE_CLUSTERED_TABLES,
+        ],
+        upstream=["classification", "subway_dedupe"],
+    ),
+]
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stage_code(function):
+    """`function` and every function of this module it references, in name order.
+
+    Names are collected from the code objects, nested ones included, so a
+    helper called from a closure or passed as a value counts too.
+    """
+    found = {}
+    pending = [function]
+    while pending:
+        function = pending.pop()
+        if function.__name__ in found:
+            continue
+        found[function.__name__] = function
+        codes = [function.__code__]
+        while codes:
+            code = codes.pop()
+            codes.extend(c for c in code.co_consts if isinstance(c, types.CodeType))
+            for name in code.co_names:
+                value = globals().get(name)
+                if isinstance(value, types.FunctionType) and value.__module__ == __name__:
+                    pending.append(value)
+    return [found[name] for name in sorted(found)]
+
+
+def _stage_fingerprints(configs=None):
+    """Fingerprint of every stage's inputs, keyed by stage name.
+
+    `configs` maps a stage name to the config to fingerprint in place of the
+    stage's current one, e.g. the CUISINES a database was built with.
+    """
+    configs = configs or {}
+    fingerprints = {}
+    for stage in BUILD_STAGES:
+        digest = hashlib.sha256(stage.name.encode("utf-8"))
+        for path in stage.files():
+            digest.update(_file_digest(path).encode("ascii"))
+        config = configs[stage.name] if stage.name in configs else stage.config()
+        digest.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+        for function in _stage_code(stage.run):
+            digest.update(inspect.getsource(function).encode("utf-8"))
+        for name in stage.upstream:
+            digest.update(fingerprints[name].encode("ascii"))
+        fingerprints[stage.name] = digest.hexdigest()
+    return fingerprints
+
+
+def _read_manifest(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS build_manifest (
+            stage VARCHAR PRIMARY KEY,
+            fingerprint VARCHAR,
+            built_at TIMESTAMP
+        )
+    """)
+    return dict(con.execute("SELECT stage, fingerprint FROM build_manifest").fetchall())
+
+
+def _record_manifest(con, stage, fingerprint):
+    con.execute(
+        "INSERT OR REPLACE INTO build_manifest VALUES (?, ?, current_localtimestamp())",
+        [stage, fingerprint],
+    )
+
+
+def build_database(verify_nearest=False, cache_path=CUISINE_CACHE_PATH, profile_rules=False,
+                   report_path=BUILD_REPORT_JSON, full=False):
+    """Bring DB_PATH up to date, re-running only stages whose inputs changed.
+
+    With full=True every stage runs from an empty database. Either way the
+    build happens on a scratch copy that only replaces DB_PATH once it has
+    been validated, so readers never see a missing or half-built file.
+    """
+    with _staged_database(copy_existing=not full) as build_path:
+        con = duckdb.connect(build_path)
+        try:
+            _run_build(con, verify_nearest, cache_path, profile_rules, report_path)
+            _validate_database(con)
+        finally:
+            con.close()
+    print(f"\nDatabase written to {DB_PATH}")
+
+
+def _run_build(con, verify_nearest, cache_path, profile_rules, report_path):
+    stats = []
+    options = {"cache_path": cache_path}
+
+    manifest = _read_manifest(con)
+    tables = {row[0] for row in con.execute("SHOW TABLES").fetchall()}
+    fingerprints = _stage_fingerprints()
+    for stage in BUILD_STAGES:
+        fingerprint = fingerprints[stage.name]
+        if manifest.get(stage.name) == fingerprint and tables.issuperset(stage.outputs):
+            print(f"Skipping {stage.name}: inputs unchanged")
+            stats.append({
+                "stage": stage.name, "skipped": True, "seconds": 0.0,
+                "duckdb_memory_bytes": None, "peak_rss_bytes": None,
+            })
+            continue
+        with _timed_stage(con, stats, stage.name):
+            stage.run(con, options)
+        _record_manifest(con, stage.name, fingerprint)
+
+    if profile_rules:
+        with _timed_stage(con, stats, "profile_rules"):
+            profile = profile_cuisine_rules(con)
+        never = sum(1 for rule in profile if rule["matches"] == 0)
+        slowest = max(profile, key=lambda rule: rule["eval_seconds"])
+        print(f"  Rule profile written to {RULE_PROFILE_JSON}: {never} rules never win, "
+              f"slowest is {slowest['cuisine']} ({slowest['eval_seconds']:.3f}s)")
+
+    if verify_nearest:
+        print("Verifying nearest stations against brute-force search...")
+        with _timed_stage(con, stats, "verify_nearest"):
+            mismatches = verify_nearest_stations(con)
+        if mismatches:
+            raise RuntimeError(f"{mismatches:,} restaurants assigned a non-nearest station")
+        print("  Grid assignment matches brute-force search")
+
+    with _timed_stage(con, stats, "model_payloads"):
+        payloads = measure_model_payloads(con)
+
     # ---- Print stats ----
     print("\n--- Cuisine Distribution ---")
     rows = con.execute("""
@@ -439,10 +1712,383 @@ def build_database():
 
     print(f"\n  Total: {sum(r[1] for r in rows):,}")
 
-    con.close()
-    print(f"\nDatabase written to {DB_PATH}")
+    print("\n--- Stage Timings ---")
+    for stage in stats:
+        timing = "skipped" if stage["skipped"] else f"{stage['seconds']:.3f}s"
+        print(f"  {stage['stage']:<25} {timing:>9}")
+
+    print("\n--- Dashboard Payloads ---")
+    if payloads is None:
+        print("  PyYAML not installed, model payload sizes not measured")
+    for payload in payloads or []:
+        print(f"  {payload['model']:<25} {payload['rows']:>7,} rows  "
+              f"{payload['parquet_bytes'] / 1024:>8.1f} KiB parquet  "
+              f"{payload['json_bytes'] / 1024:>8.1f} KiB json")
+    if report_path is not None:
+        _write_build_report(con, stats, report_path, payloads)
+        print(f"  Report written to {report_path}")
+
+
+def _sql_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+# Per-cuisine shard layers: name -> (table, columns). The cuisine column is
+# left out since every row of a shard has the same one.
+SHARD_LAYERS = {
+    "restaurants": ("restaurant_markers", ["latitude", "longitude", "label"]),
+    "stations": ("station_cuisine_rank", [
+        "complex_id", "station_name", "station_lat", "station_lon", "station_routes",
+        "restaurant_count", "rank",
+    ]),
+    "clusters": ("restaurant_clusters", [
+        "zoom", "cell_x", "cell_y", "restaurant_count", "latitude", "longitude",
+    ]),
+}
+
+
+def export_cuisine_shards(out_dir=SHARDS_DIR):
+    """Write one Parquet file per cuisine and layer from DB_PATH, plus index.json.
+
+    Shards are named by cuisine_id (labels contain characters like '/') and
+    listed in index.json with their label, row count and size, so a client
+    fetches only the shards for the selected cuisine. The new set is written
+    beside out_dir and swapped in when complete.
+    """
+    staging_dir = out_dir + ".tmp"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    con = duckdb.connect(DB_PATH, read_only=True)
+    try:
+        cuisines = con.execute("""
+            SELECT cuisine_id, cuisine::VARCHAR
+            FROM cuisines
+            WHERE cuisine IN (SELECT cuisine FROM restaurant_markers)
+            ORDER BY cuisine_id
+        """).fetchall()
+        index = []
+        for cuisine_id, cuisine in cuisines:
+            entry = {"cuisine_id": cuisine_id, "cuisine": cuisine}
+            for layer, (table, columns) in SHARD_LAYERS.items():
+                path = os.path.join(layer, f"{cuisine_id}.parquet")
+                os.makedirs(os.path.join(staging_dir, layer), exist_ok=True)
+                con.execute(f"""
+                    COPY (
+                        SELECT {", ".join(columns)}
+                        FROM {table}
+                        WHERE cuisine = {_sql_literal(cuisine)}::cuisine_label
+                    ) TO '{os.path.join(staging_dir, path)}' (FORMAT parquet, COMPRESSION zstd)
+                """)
+                rows = con.execute(f"""
+                    SELECT COUNT(*) FROM {table}
+                    WHERE cuisine = {_sql_literal(cuisine)}::cuisine_label
+                """).fetchone()[0]
+                entry[layer] = {
+                    "path": path.replace(os.sep, "/"),
+                    "rows": rows,
+                    "bytes": os.path.getsize(os.path.join(staging_dir, path)),
+                }
+            index.append(entry)
+    finally:
+        con.close()
+    with open(os.path.join(staging_dir, "index.json"), "w") as f:
+        json.dump({"format": "parquet", "layers": list(SHARD_LAYERS), "cuisines": index},
+                  f, indent=2)
+
+    retired_dir = out_dir + ".old"
+    shutil.rmtree(retired_dir, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.replace(out_dir, retired_dir)
+    os.replace(staging_dir, out_dir)
+    shutil.rmtree(retired_dir, ignore_errors=True)
+
+    total = sum(entry[layer]["bytes"] for entry in index for layer in SHARD_LAYERS)
+    print(f"Wrote {len(index) * len(SHARD_LAYERS):,} shards for {len(index):,} cuisines "
+          f"({total / 1024:.1f} KiB) to {out_dir}")
+
+
+def reclassify_incremental(cache_path=CUISINE_CACHE_PATH):
+    """Patch an existing database in place after CUISINES patterns were edited.
+
+    Only rules whose pattern changed are considered. A name can only change
+    cuisine if it was assigned by one of those rules, or if it was assigned
+    by a later rule (or no rule) and now matches a changed rule's new
+    pattern. Just those names are re-run through the classifier; the rows
+    they touch in classified_restaurants and restaurants_with_station are
+    updated, and the station counts, rankings, markers and clusters they feed
+    are recomputed for the affected stations and cuisines only. Adding,
+    removing, renaming or reordering rules, or editing the lookup TSV, still
+    needs a full build, and any other change to a stage's inputs since the
+    last build needs a normal one.
+    """
+    if not os.path.exists(DB_PATH):
+        raise RuntimeError(f"{DB_PATH} does not exist; run a full build first")
+    with _staged_database(copy_existing=True) as build_path:
+        con = duckdb.connect(build_path)
+        try:
+            _reclassify_changed_rules(con, cache_path)
+            _validate_database(con)
+        finally:
+            con.close()
+
+
+def _reclassify_changed_rules(con, cache_path):
+    tables = {row[0] for row in con.execute("SHOW TABLES").fetchall()}
+    if not {"cuisine_rules", "build_info", "name_cuisine"} <= tables:
+        raise RuntimeError("database predates incremental builds; run a full build")
+    old_rules = con.execute(
+        "SELECT cuisine, pattern FROM cuisine_rules ORDER BY rule_index"
+    ).fetchall()
+    if [label for label, _ in old_rules] != [label for label, _ in CUISINES]:
+        raise RuntimeError("CUISINES labels were added, removed or reordered; run a full build")
+    lookup_fingerprint = con.execute(
+        "SELECT value FROM build_info WHERE key = 'lookup_fingerprint'"
+    ).fetchone()[0]
+    if lookup_fingerprint != _lookup_fingerprint():
+        raise RuntimeError(f"{CUISINE_LOOKUP_TSV} changed; run a full build")
+    latitude_type = con.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'restaurants_with_station' AND column_name = 'latitude'
+    """).fetchone()[0]
+    if (latitude_type == QUANTIZED_COORD_TYPE.replace(" ", "")) != QUANTIZE_COORDS:
+        flag = "without" if QUANTIZE_COORDS else "with"
+        raise RuntimeError(
+            f"database coordinates are {latitude_type}; rerun {flag} --quantize-coords"
+        )
+    # The patches below only account for the CUISINES edit. Every stage must
+    # be exactly as the last build left it, judged with the old rules, or its
+    # other changes would be marked as built without ever running.
+    built = _stage_fingerprints({"classification": [[list(rule) for rule in old_rules]]})
+    manifest = _read_manifest(con)
+    stale = [stage.name for stage in BUILD_STAGES if manifest.get(stage.name) != built[stage.name]]
+    if stale:
+        raise RuntimeError(
+            f"stages {', '.join(stale)} changed besides CUISINES; run a normal build"
+        )
+
+    changed = [
+        i for i, ((_, old), (_, new)) in enumerate(zip(old_rules, CUISINES))
+        if old != new
+    ]
+    if not changed:
+        print("No CUISINES patterns changed, nothing to do.")
+        return
+    print(f"Reclassifying for changed rules: {', '.join(CUISINES[i][0] for i in changed)}")
+
+    # Names assigned by a changed rule may lose it; names assigned by a
+    # later rule, or by none, may now be claimed by a changed rule.
+    con.execute(f"CREATE TEMP TABLE lookup_cuisine AS {_lookup_cuisine_sql()}")
+    new_patterns = [(i, re.compile(CUISINES[i][1], re.ASCII)) for i in changed]
+    rows = con.execute(f"""
+        SELECT normalized_name, rule_index
+        FROM name_cuisine
+        ANTI JOIN lookup_cuisine USING (normalized_name)
+        WHERE rule_index IS NULL OR rule_index >= {changed[0]}
+    """).fetchall()
+    candidates = [
+        name for name, rule_index in rows
+        if rule_index in changed
+        or any(
+            i < (len(CUISINES) if rule_index is None else rule_index)
+            and pattern.search(name)
+            for i, pattern in new_patterns
+        )
+    ]
+
+    classify = _compile_cuisine_classifier()
+    _load_rows(
+        con, "reclassified",
+        {"normalized_name": "VARCHAR", "rule_index": "INTEGER"},
+        ((name, classify(name)) for name in candidates),
+    )
+
+    con.execute("BEGIN TRANSACTION")
+    _write_cuisine_rules(con)
+    con.execute("""
+        CREATE TEMP TABLE changed_names AS
+        SELECT
+            r.normalized_name,
+            r.rule_index,
+            COALESCE(cr.cuisine, 'Unclassified')::cuisine_label AS cuisine,
+            COALESCE(nc.cuisine, 'Unclassified')::cuisine_label AS old_cuisine
+        FROM reclassified r
+        JOIN name_cuisine nc USING (normalized_name)
+        LEFT JOIN cuisine_rules cr ON cr.rule_index = r.rule_index
+        WHERE r.rule_index IS DISTINCT FROM nc.rule_index
+    """)
+    con.execute("""
+        UPDATE name_cuisine nc
+        SET rule_index = c.rule_index, cuisine = c.cuisine
+        FROM changed_names c
+        WHERE nc.normalized_name = c.normalized_name
+    """)
+    con.execute("""
+        UPDATE classified_restaurants r
+        SET cuisine = c.cuisine
+        FROM changed_names c
+        WHERE LOWER(TRIM(r.restaurant_name)) = c.normalized_name
+    """)
+    # Stations whose counts need recomputing: where the moved restaurants are.
+    con.execute("""
+        CREATE TEMP TABLE affected_stations AS
+        SELECT DISTINCT complex_id
+        FROM restaurants_with_station
+        WHERE LOWER(TRIM(restaurant_name)) IN (SELECT normalized_name FROM changed_names)
+    """)
+    con.execute("""
+        UPDATE restaurants_with_station r
+        SET cuisine = c.cuisine
+        FROM changed_names c
+        WHERE LOWER(TRIM(r.restaurant_name)) = c.normalized_name
+    """)
+    con.execute("""
+        DELETE FROM station_cuisine_counts
+        WHERE complex_id IN (SELECT complex_id FROM affected_stations)
+    """)
+    con.execute("""
+        INSERT INTO station_cuisine_counts
+        SELECT
+            c.complex_id,
+            s.stop_name,
+            s.latitude,
+            s.longitude,
+            s.all_routes,
+            c.cuisine,
+            c.restaurant_count
+        FROM (
+            SELECT complex_id, cuisine, COUNT(*) AS restaurant_count
+            FROM restaurants_with_station
+            SEMI JOIN affected_stations USING (complex_id)
+            GROUP BY complex_id, cuisine
+        ) c
+        JOIN subway_stations s USING (complex_id)
+    """)
+    # Rankings change for the cuisines restaurants moved out of and into.
+    con.execute("""
+        DELETE FROM station_cuisine_rank
+        WHERE cuisine IN (
+            SELECT cuisine FROM changed_names UNION SELECT old_cuisine FROM changed_names
+        )
+    """)
+    con.execute(f"""
+        INSERT INTO station_cuisine_rank
+        SELECT * FROM ({_station_rank_sql()})
+        WHERE cuisine IN (
+            SELECT cuisine FROM changed_names UNION SELECT old_cuisine FROM changed_names
+        )
+    """)
+    con.execute("""
+        DELETE FROM restaurant_clusters
+        WHERE cuisine IN (
+            SELECT cuisine FROM changed_names UNION SELECT old_cuisine FROM changed_names
+        )
+    """)
+    con.execute(f"""
+        INSERT INTO restaurant_clusters
+        SELECT * FROM ({_restaurant_clusters_sql()})
+        WHERE cuisine IN (
+            SELECT cuisine FROM changed_names UNION SELECT old_cuisine FROM changed_names
+        )
+    """)
+    # Radius counts change at every station within reach of a moved restaurant.
+    _count_within_radii(
+        con,
+        """(SELECT * FROM classified_restaurants
+            WHERE LOWER(TRIM(restaurant_name)) IN (SELECT normalized_name FROM changed_names))""",
+        "subway_stations",
+    )
+    con.execute("""
+        CREATE TEMP TABLE affected_radius_stations AS
+        SELECT * FROM subway_stations
+        WHERE complex_id IN (SELECT complex_id FROM radius_counts)
+    """)
+    _count_within_radii(con, "classified_restaurants", "affected_radius_stations")
+    con.execute("""
+        DELETE FROM station_radius_counts
+        WHERE complex_id IN (SELECT complex_id FROM affected_radius_stations)
+    """)
+    con.execute("""
+        INSERT INTO station_radius_counts
+        SELECT
+            c.complex_id,
+            s.stop_name,
+            s.latitude,
+            s.longitude,
+            s.all_routes,
+            c.radius_m,
+            c.cuisine,
+            c.restaurant_count
+        FROM radius_counts c
+        JOIN subway_stations s USING (complex_id)
+    """)
+    _write_restaurant_markers(con)
+    # Updates and appends leave rows out of cuisine order; restore it.
+    for table in CUISINE_CLUSTERED_TABLES:
+        _recluster(con, table)
+    # The patched tables now match what a build with the new CUISINES would
+    # produce; only the stages from classification down change fingerprint.
+    fingerprints = _stage_fingerprints()
+    for stage in BUILD_STAGES:
+        if fingerprints[stage.name] != built[stage.name]:
+            _record_manifest(con, stage.name, fingerprints[stage.name])
+    con.execute("COMMIT")
+
+    moved = con.execute("SELECT COUNT(*) FROM changed_names").fetchone()[0]
+    stations = con.execute("SELECT COUNT(*) FROM affected_stations").fetchone()[0]
+    print(f"  {len(candidates):,} of {len(rows):,} names re-evaluated, "
+          f"{moved:,} changed cuisine, {stations:,} stations recounted")
+
+    # Seed the cache for the new ruleset so the next full build is a hit.
+    fingerprint = _ruleset_fingerprint()
+    cache = _open_cuisine_cache(con, cache_path, fingerprint)
+    con.execute(f"""
+        INSERT OR REPLACE INTO {cache}
+        SELECT normalized_name, ?, rule_index, cuisine FROM name_cuisine
+    """, [fingerprint])
 
 
 if __name__ == "__main__":
-    download_subway_data()
-    build_database()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--verify-nearest", action="store_true",
+        help="check the grid nearest-station assignment against a brute-force search",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="classify every restaurant name without reading or updating the cuisine cache",
+    )
+    parser.add_argument(
+        "--profile-rules", action="store_true",
+        help="report per-rule match, shadowed-match and timing counts for CUISINES",
+    )
+    parser.add_argument(
+        "--full", action="store_true",
+        help="delete the database and re-run every build stage",
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="patch the existing database for edited CUISINES patterns instead of rebuilding",
+    )
+    parser.add_argument(
+        "--quantize-coords", action="store_true",
+        help="store serving-table coordinates as fixed-point 1e-5 degree int32 decimals",
+    )
+    parser.add_argument(
+        "--export-shards", nargs="?", const=SHARDS_DIR, metavar="DIR",
+        help=f"after building, write per-cuisine Parquet shards (default {SHARDS_DIR})",
+    )
+    args = parser.parse_args()
+
+    cache_path = None if args.no_cache else CUISINE_CACHE_PATH
+    QUANTIZE_COORDS = args.quantize_coords
+    if args.incremental:
+        reclassify_incremental(cache_path=cache_path)
+    else:
+        download_subway_data()
+        build_database(
+            verify_nearest=args.verify_nearest,
+            cache_path=cache_path,
+            profile_rules=args.profile_rules,
+            full=args.full,
+        )
+    if args.export_shards:
+        export_cuisine_shards(args.export_shards)
@@ -0,0 +1,370 @@
+# /// script
+# requires-python = ">=3.10"
+# dependencies = ["duckdb"]
+# ///
+"""
+Vector-tile archive generator for the NYC Restaurant Cuisine Dashboard.
+
+Reads nyc_food.duckdb and writes a single PMTiles v3 file of Mapbox Vector
+Tiles with three point layers: restaurants (zoomed in), restaurant clusters
+(zoomed out) and subway stations. Features are streamed from DuckDB in tile
+order, so memory holds one tile at a time however large the extract is. A
+static host serves the archive to map clients with HTTP range requests.
+"""
+
+import argparse
+import collections
+import gzip
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+
+import duckdb
+
+import setup
+
+TILES_PATH = os.path.join(setup.DATA_DIR, "nyc_food.pmtiles")
+
+# Restaurants are drawn one by one from this zoom; below it the tiles carry
+# the restaurant_clusters cells instead.
+POINT_MIN_ZOOM = 14
+
+MVT_EXTENT = 4096
+FETCH_ROWS = 10_000
+
+# Header plus root directory must fit in the first 16 KiB of the archive.
+PMTILES_HEADER_BYTES = 127
+PMTILES_ROOT_MAX_BYTES = 16384 - PMTILES_HEADER_BYTES
+PMTILES_COMPRESSION_GZIP = 2
+PMTILES_TILE_TYPE_MVT = 1
+
+# Feature attributes per layer, in the column order of the tile query.
+LAYER_FIELDS = {
+    "restaurants": {"name": "String", "cuisine": "String", "station": "String"},
+    "clusters": {"cuisine": "String", "restaurant_count": "Number"},
+    "stations": {"name": "String", "routes": "String"},
+}
+PROPERTY_COLUMNS = ["name", "cuisine", "station", "routes", "restaurant_count"]
+
+Entry = collections.namedtuple("Entry", ["tile_id", "offset", "length", "run_length"])
+
+
+# ---- Protocol buffers (just what the MVT schema needs) ----
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _key(field, wire_type):
+    return _varint(field << 3 | wire_type)
+
+
+def _uint_field(field, n):
+    return _key(field, 0) + _varint(n)
+
+
+def _bytes_field(field, payload):
+    return _key(field, 2) + _varint(len(payload)) + payload
+
+
+def _packed_field(field, values):
+    return _bytes_field(field, b"".join(_varint(v) for v in values))
+
+
+def _mvt_value(value):
+    """Encode a Tile.Value message."""
+    if isinstance(value, str):
+        return _bytes_field(1, value.encode())
+    if isinstance(value, float):
+        return _key(3, 1) + struct.pack("<d", value)
+    if value >= 0:
+        return _uint_field(5, value)
+    return _uint_field(6, _zigzag(value))
+
+
+class _MvtLayer:
+    """Accumulates point features of one layer with its key and value tables."""
+
+    def __init__(self, name):
+        self.name = name
+        self.keys = {}
+        self.values = {}
+        self.features = []
+
+    def add_point(self, x, y, properties):
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(self.keys.setdefault(key, len(self.keys)))
+            tags.append(self.values.setdefault((type(value), value), len(self.values)))
+        # One MoveTo command with a single zigzag-encoded (x, y) pair.
+        geometry = [1 | 1 << 3, _zigzag(x), _zigzag(y)]
+        self.features.append(
+            _packed_field(2, tags) + _uint_field(3, 1) + _packed_field(4, geometry)
+        )
+
+    def encode(self):
+        return b"".join([
+            _uint_field(15, 2),
+            _bytes_field(1, self.name.encode()),
+            *(_bytes_field(2, feature) for feature in self.features),
+            *(_bytes_field(3, key.encode()) for key in self.keys),
+            *(_bytes_field(4, _mvt_value(value)) for _, value in self.values),
+            _uint_field(5, MVT_EXTENT),
+        ])
+
+
+def _encode_tile(layers):
+    return b"".join(_bytes_field(3, layer.encode()) for layer in layers.values())
+
+
+# ---- PMTiles v3 ----
+
+def _tile_id(z, x, y):
+    """PMTiles tile id: tiles of all lower zooms, then Hilbert order within z."""
+    tile_id = ((1 << 2 * z) - 1) // 3
+    for a in range(z - 1, -1, -1):
+        s = 1 << a
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += ((3 * rx) ^ ry) << 2 * a
+        if ry == 0:
+            if rx == 1:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+    return tile_id
+
+
+def _serialize_directory(entries):
+    out = bytearray(_varint(len(entries)))
+    last_id = 0
+    for entry in entries:
+        out += _varint(entry.tile_id - last_id)
+        last_id = entry.tile_id
+    for entry in entries:
+        out += _varint(entry.run_length)
+    for entry in entries:
+        out += _varint(entry.length)
+    for i, entry in enumerate(entries):
+        previous = entries[i - 1] if i else None
+        if previous and entry.offset == previous.offset + previous.length:
+            out += _varint(0)
+        else:
+            out += _varint(entry.offset + 1)
+    return gzip.compress(bytes(out), mtime=0)
+
+
+def _build_directories(entries):
+    """Return (root, leaves): the root directory, split into leaves if too big."""
+    root = _serialize_directory(entries)
+    if len(root) <= PMTILES_ROOT_MAX_BYTES:
+        return root, b""
+    leaf_size = 4096
+    while True:
+        leaves = bytearray()
+        root_entries = []
+        for i in range(0, len(entries), leaf_size):
+            leaf = _serialize_directory(entries[i:i + leaf_size])
+            root_entries.append(Entry(entries[i].tile_id, len(leaves), len(leaf), 0))
+            leaves += leaf
+        root = _serialize_directory(root_entries)
+        if len(root) <= PMTILES_ROOT_MAX_BYTES:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+def _merge_runs(entries):
+    """Sort by tile id and fold consecutive tiles with the same content into runs."""
+    merged = []
+    for entry in sorted(entries):
+        last = merged[-1] if merged else None
+        if (last and entry.offset == last.offset
+                and entry.tile_id == last.tile_id + last.run_length):
+            merged[-1] = last._replace(run_length=last.run_length + 1)
+        else:
+            merged.append(entry)
+    return merged
+
+
+# ---- Tiles from DuckDB ----
+
+def _tile_features_sql(min_zoom, max_zoom, point_min_zoom):
+    """Every feature of every tile as (zoom, tile_x, tile_y, layer, x, y, properties...)."""
+    return f"""
+        WITH zooms AS (
+            SELECT CAST(z AS INTEGER) AS zoom FROM range({min_zoom}, {max_zoom + 1}) t(z)
+        ),
+        features AS (
+            SELECT
+                z.zoom, 'restaurants' AS layer, r.latitude, r.longitude,
+                r.restaurant_name AS name, CAST(r.cuisine AS VARCHAR) AS cuisine,
+                r.station_name AS station, NULL AS routes, NULL AS restaurant_count
+            FROM restaurants_with_station r
+            JOIN zooms z ON z.zoom >= {point_min_zoom}
+            UNION ALL
+            SELECT
+                c.zoom, 'clusters', c.latitude, c.longitude,
+                NULL, CAST(c.cuisine AS VARCHAR), NULL, NULL, c.restaurant_count
+            FROM restaurant_clusters c
+            WHERE c.zoom BETWEEN {min_zoom} AND {min(point_min_zoom - 1, max_zoom)}
+            UNION ALL
+            SELECT
+                z.zoom, 'stations', s.latitude, s.longitude,
+                s.stop_name, NULL, NULL, s.all_routes, NULL
+            FROM subway_stations s
+            CROSS JOIN zooms z
+        ),
+        projected AS (
+            SELECT
+                *,
+                (CAST(longitude AS DOUBLE) + 180) / 360 * pow(2, zoom) AS fx,
+                (1 - LN(TAN(RADIANS(latitude)) + 1 / COS(RADIANS(latitude))) / PI()) / 2
+                    * pow(2, zoom) AS fy
+            FROM features
+        )
+        SELECT
+            zoom,
+            CAST(FLOOR(fx) AS INTEGER) AS tile_x,
+            CAST(FLOOR(fy) AS INTEGER) AS tile_y,
+            layer,
+            CAST(FLOOR((fx - FLOOR(fx)) * {MVT_EXTENT}) AS INTEGER) AS x,
+            CAST(FLOOR((fy - FLOOR(fy)) * {MVT_EXTENT}) AS INTEGER) AS y,
+            {", ".join(PROPERTY_COLUMNS)}
+        FROM projected
+        ORDER BY zoom, tile_x, tile_y, layer
+    """
+
+
+def _stream_tiles(con, min_zoom, max_zoom, point_min_zoom):
+    """Yield ((z, x, y), encoded tile) for every non-empty tile, in query order."""
+    result = con.execute(_tile_features_sql(min_zoom, max_zoom, point_min_zoom))
+    current, layers = None, {}
+    while rows := result.fetchmany(FETCH_ROWS):
+        for zoom, tile_x, tile_y, layer, x, y, *values in rows:
+            if (zoom, tile_x, tile_y) != current:
+                if layers:
+                    yield current, _encode_tile(layers)
+                current, layers = (zoom, tile_x, tile_y), {}
+            if layer not in layers:
+                layers[layer] = _MvtLayer(layer)
+            properties = dict(zip(PROPERTY_COLUMNS, values))
+            layers[layer].add_point(
+                x, y, {key: properties[key] for key in LAYER_FIELDS[layer]},
+            )
+    if layers:
+        yield current, _encode_tile(layers)
+
+
+def write_tile_archive(out_path=TILES_PATH, min_zoom=setup.CLUSTER_MIN_ZOOM,
+                       max_zoom=setup.CLUSTER_MAX_ZOOM, point_min_zoom=POINT_MIN_ZOOM):
+    """Write restaurants, clusters and stations from DB_PATH as a PMTiles archive.
+
+    Tiles are gzipped and appended to a scratch file as they stream out of
+    DuckDB; identical tiles are stored once. The directory is sorted by tile
+    id afterwards, and the archive is assembled beside out_path and renamed
+    into place.
+    """
+    con = duckdb.connect(setup.DB_PATH, read_only=True)
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    entries, contents = [], {}
+    tile_bytes = 0
+    try:
+        bounds = con.execute("""
+            SELECT
+                CAST(MIN(longitude) AS DOUBLE), CAST(MIN(latitude) AS DOUBLE),
+                CAST(MAX(longitude) AS DOUBLE), CAST(MAX(latitude) AS DOUBLE)
+            FROM restaurants_with_station
+        """).fetchone()
+        with tempfile.TemporaryFile(dir=out_dir) as data:
+            for (z, x, y), tile in _stream_tiles(con, min_zoom, max_zoom, point_min_zoom):
+                tile = gzip.compress(tile, mtime=0)
+                digest = hashlib.sha256(tile).digest()
+                if digest not in contents:
+                    contents[digest] = (tile_bytes, len(tile))
+                    data.write(tile)
+                    tile_bytes += len(tile)
+                offset, length = contents[digest]
+                entries.append(Entry(_tile_id(z, x, y), offset, length, 1))
+            if not entries:
+                raise RuntimeError(f"{setup.DB_PATH} has no features to tile")
+
+            addressed = len(entries)
+            entries = _merge_runs(entries)
+            root, leaves = _build_directories(entries)
+            metadata = gzip.compress(json.dumps({
+                "name": "nyc_food",
+                "format": "pbf",
+                "vector_layers": [
+                    {
+                        "id": layer,
+                        "fields": fields,
+                        "minzoom": point_min_zoom if layer == "restaurants" else min_zoom,
+                        "maxzoom": point_min_zoom - 1 if layer == "clusters" else max_zoom,
+                    }
+                    for layer, fields in LAYER_FIELDS.items()
+                ],
+            }).encode(), mtime=0)
+
+            min_lon, min_lat, max_lon, max_lat = (round(v * 1e7) for v in bounds)
+            root_offset = PMTILES_HEADER_BYTES
+            metadata_offset = root_offset + len(root)
+            leaves_offset = metadata_offset + len(metadata)
+            data_offset = leaves_offset + len(leaves)
+            header = struct.pack(
+                "<7sB11Q6B4iB2i",
+                b"PMTiles", 3,
+                root_offset, len(root),
+                metadata_offset, len(metadata),
+                leaves_offset, len(leaves),
+                data_offset, tile_bytes,
+                addressed, len(entries), len(contents),
+                0,  # tile data is not in tile id order
+                PMTILES_COMPRESSION_GZIP, PMTILES_COMPRESSION_GZIP, PMTILES_TILE_TYPE_MVT,
+                min_zoom, max_zoom,
+                min_lon, min_lat, max_lon, max_lat,
+                min_zoom, (min_lon + max_lon) // 2, (min_lat + max_lat) // 2,
+            )
+
+            tmp_path = out_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(header + root + metadata + leaves)
+                data.seek(0)
+                while chunk := data.read(1 << 20):
+                    f.write(chunk)
+            os.replace(tmp_path, out_path)
+    finally:
+        con.close()
+
+    print(f"Wrote {addressed:,} tiles ({len(contents):,} distinct, "
+          f"{tile_bytes / 1024:.1f} KiB) for zoom {min_zoom}-{max_zoom} to {out_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-o", "--output", default=TILES_PATH)
+    parser.add_argument("--min-zoom", type=int, default=setup.CLUSTER_MIN_ZOOM)
+    parser.add_argument("--max-zoom", type=int, default=setup.CLUSTER_MAX_ZOOM)
+    parser.add_argument(
+        "--point-min-zoom", type=int, default=POINT_MIN_ZOOM,
+        help="first zoom with individual restaurants; lower zooms get clusters",
+    )
+    args = parser.parse_args()
+    write_tile_archive(args.output, args.min_zoom, args.max_zoom, args.point_min_zoom)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())